@@ -0,0 +1,65 @@
+import os
+import time
+import argparse
+import numpy as np
+import cv2 as cv
+from GrabCut import GrabCut, Trimap
+from GCGraph import GCGraph
+from CutBackends import BACKENDS, maxflow
+from PyramidReport import IMG_DIR, test_images, default_rect
+
+
+# Rect trimap, and a band trimap of bandWidth pixels around the matte of a first GrabCut run
+def trimaps(img, bandWidth):
+    grabcut = GrabCut(img, iterCount=2, useCV=False, backend='opencv')
+    rect = default_rect(img.shape[:2], False)
+    matte = grabcut.segment(rect, None)
+    rectTrimap = np.full(img.shape[:2], Trimap.BGD, np.uint8)
+    rectTrimap[rect[1]:rect[3], rect[0]:rect[2]] = Trimap.UKN
+    kernel = cv.getStructuringElement(cv.MORPH_ELLIPSE, (2*bandWidth + 1, 2*bandWidth + 1))
+    bandTrimap = np.full(img.shape[:2], Trimap.UKN, np.uint8)
+    bandTrimap[cv.erode(matte, kernel) == 1] = Trimap.FGD
+    bandTrimap[cv.dilate(matte, kernel) == 0] = Trimap.BGD
+    return grabcut.get_models(), {'rect': rectTrimap, 'band': bandTrimap}
+
+
+# Seconds to build and cut the same graph with backend, and the labels
+def time_cut(img, trimap, models, backend):
+    graph = GCGraph(img, backend=backend)
+    start = time.perf_counter()
+    graph.build_graph(trimap, *models)
+    labels = graph.cut()
+    return time.perf_counter() - start, labels
+
+
+'''
+Time the max-flow backends (build + cut of the same graph, same capacities) on the images of
+test/imgs resized to several sizes, for a rect trimap and a narrow band trimap, and count the
+labels on which each backend disagrees with the first one.
+'''
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Max-flow backends by image size')
+    parser.add_argument('--imgs', default=IMG_DIR)
+    parser.add_argument('--sizes', default='160,320,640', help='comma separated widths')
+    parser.add_argument('--images', type=int, default=3, help='number of test images')
+    parser.add_argument('--band', type=int, default=8, help='width of the band trimap')
+    args = parser.parse_args()
+    backends = [name for name in BACKENDS if name != 'pymaxflow' or maxflow is not None]
+
+    print('| image | size | trimap | ' + ' | '.join('%s (s)' % name for name in backends) + ' | fastest | differing labels |')
+    print('|---' * (5 + len(backends)) + '|')
+    for imagePath in list(test_images(args.imgs))[:args.images]:
+        original = cv.imread(imagePath)
+        for width in [int(s) for s in args.sizes.split(',')]:
+            img = cv.resize(original, (width, width * original.shape[0] // original.shape[1]), interpolation=cv.INTER_AREA)
+            models, masks = trimaps(img, args.band)
+            for name, trimap in masks.items():
+                times, differing, ref = [], [], None
+                for backend in backends:
+                    t, labels = time_cut(img, trimap, models, backend)
+                    ref = labels if ref is None else ref
+                    times.append(t)
+                    differing.append(int(np.count_nonzero(labels != ref)))
+                print('| %s | %dx%d | %s | %s | %s | %s |' % (
+                    os.path.basename(imagePath), img.shape[1], img.shape[0], name, ' | '.join('%.3f' % t for t in times),
+                    backends[int(np.argmin(times))], ' / '.join(map(str, differing))))
@@ -0,0 +1,142 @@
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import cv2 as cv
+from GrabCut import GrabCut, Trimap, file_sink
+
+BLAS_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+'''
+Manifest: one entry per line, blank lines and lines starting with # are skipped
+    image_path,x1,y1,x2,y2      rect in pixels (x, y, w, h for --cv, like cv.grabCut)
+    image_path,mask_path        trimap image: 0 = background, 255 = foreground, anything else unknown
+Relative paths are resolved against the manifest's directory.
+'''
+def read_manifest(manifestPath):
+    root = os.path.dirname(os.path.abspath(manifestPath))
+    entries = []
+    with open(manifestPath) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = [field.strip() for field in line.split(',')]
+            imagePath = os.path.join(root, fields[0])
+            if len(fields) == 5:
+                entries.append((imagePath, tuple(int(v) for v in fields[1:]), None))
+            elif len(fields) == 2:
+                entries.append((imagePath, None, os.path.join(root, fields[1])))
+            else:
+                raise ValueError("Bad manifest line: " + line)
+    return entries
+
+
+# maskPath may also be the encoded bytes of the mask image
+def read_trimap(maskPath):
+    if isinstance(maskPath, bytes):
+        mask = cv.imdecode(np.frombuffer(maskPath, np.uint8), cv.IMREAD_GRAYSCALE)
+        if mask is None:
+            raise ValueError("Cannot decode the mask bytes")
+    else:
+        mask = cv.imread(maskPath, cv.IMREAD_GRAYSCALE)
+        if mask is None:
+            raise IOError("Cannot read " + maskPath)
+    trimap = np.full(mask.shape, Trimap.UKN, np.uint8)
+    trimap[mask == 0] = Trimap.BGD
+    trimap[mask == 255] = Trimap.FGD
+    return trimap
+
+
+# Output names of the entries' images: their paths relative to the images' common directory,
+# without extension, so that a/img.jpg and b/img.jpg do not overwrite each other (nor resume
+# skip the second one). Images that would still share their outputs, e.g. the same image
+# listed twice or img.jpg next to img.png, are rejected.
+def output_names(entries):
+    imagePaths = [os.path.abspath(imagePath) for imagePath, _, _ in entries]
+    if not imagePaths:
+        return []
+    root = os.path.commonpath([os.path.dirname(imagePath) for imagePath in imagePaths])
+    names, seen = [], {}
+    for imagePath in imagePaths:
+        name = os.path.splitext(os.path.relpath(imagePath, root))[0]
+        if name in seen:
+            raise ValueError("%s and %s would write the same outputs" % (seen[name], imagePath))
+        seen[name] = imagePath
+        names.append(name)
+    return names
+
+
+def output_paths(outDir, name):
+    return os.path.join(outDir, name + '_matte.png'), os.path.join(outDir, name + '_cutout.png')
+
+
+def init_worker(blasThreads):
+    # BLAS pools are sized from the environment when numpy loads, which the spawned
+    # workers inherit from the parent; OpenCV has its own pool
+    cv.setNumThreads(blasThreads)
+
+
+def process(task):
+    imagePath, rect, maskPath, (mattePath, cutoutPath), options = task
+    start = time.time()
+    try:
+        os.makedirs(os.path.dirname(mattePath), exist_ok=True)
+        grabcut = GrabCut(imagePath, **options)
+        trimap = None if maskPath is None else read_trimap(maskPath)
+        # Reported with the image as the manifest row image_path,mask_path
+        if trimap is not None and trimap.shape != grabcut.imgShape:
+            raise ValueError("%s,%s: the mask is %dx%d, the image %dx%d" % (
+                imagePath, maskPath, trimap.shape[1], trimap.shape[0], grabcut.imgShape[1], grabcut.imgShape[0]))
+        grabcut.run(rect, trimap, file_sink(cutoutPath))
+        cv.imwrite(mattePath, grabcut.get_alpha(np.uint8))
+        return imagePath, time.time() - start, None
+    except Exception as e:
+        return imagePath, time.time() - start, repr(e)
+
+
+def run_batch(entries, outDir, workers=1, blasThreads=1, resume=True, **options):
+    os.makedirs(outDir, exist_ok=True)
+    tasks = [(imagePath, rect, maskPath, output_paths(outDir, name), options)
+             for (imagePath, rect, maskPath), name in zip(entries, output_names(entries))]
+    tasks = [task for task in tasks if not (resume and all(os.path.exists(p) for p in task[3]))]
+    print("%d images, %d already done" % (len(entries), len(entries) - len(tasks)))
+    for var in BLAS_ENV_VARS:
+        os.environ[var] = str(blasThreads)
+    latencies, failed = [], 0
+    start = time.time()
+    with multiprocessing.get_context('spawn').Pool(workers, init_worker, (blasThreads, )) as pool:
+        for imagePath, latency, error in pool.imap_unordered(process, tasks):
+            if error is None:
+                latencies.append(latency)
+            else:
+                failed += 1
+                print("FAILED", imagePath, error, file=sys.stderr)
+    elapsed = time.time() - start
+    if latencies:
+        print("%d done, %d failed in %.1fs: %.2f images/s, latency p50 %.3fs p95 %.3fs" % (
+            len(latencies), failed, elapsed, len(latencies) / elapsed,
+            np.percentile(latencies, 50), np.percentile(latencies, 95)))
+    return latencies, failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Segment the images of a manifest with GrabCut')
+    parser.add_argument('manifest')
+    parser.add_argument('out', help='output directory for <name>_matte.png and <name>_cutout.png, <name> '
+                                    'keeping the subdirectories of the images')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--blas-threads', type=int, default=1, help='BLAS/OpenCV threads per worker')
+    parser.add_argument('--overwrite', action='store_true', help='redo images whose outputs already exist')
+    parser.add_argument('--iter', type=int, default=3)
+    parser.add_argument('--cv', action='store_true', help='use the OpenCV engine')
+    parser.add_argument('--pyramid', default='', help='comma separated scale factors, e.g. 0.5,0.25')
+    parser.add_argument('--border', type=int, default=None, help='soft alpha in a band of this many pixels')
+    args = parser.parse_args()
+    run_batch(read_manifest(args.manifest), args.out, args.workers, args.blas_threads, not args.overwrite,
+              iterCount=args.iter, useCV=args.cv,
+              pyramid=tuple(float(s) for s in args.pyramid.split(',') if s), borderMatting=args.border)
@@ -0,0 +1,113 @@
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import argparse
+import subprocess
+import multiprocessing
+import numpy as np
+import cv2 as cv
+from CutBackends import maxflow
+from GrabCut import GrabCut
+from Instrumentation import Instrumentation
+from PyramidReport import IMG_DIR, test_images, default_rect, iou
+
+
+def current_rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2**20
+
+
+def segment(imagePath, scale, useCV, options, queue):
+    img = cv.imread(imagePath)
+    if scale != 1:
+        img = cv.resize(img, None, fx=scale, fy=scale,
+                        interpolation=cv.INTER_AREA if scale < 1 else cv.INTER_CUBIC)
+    baseRSS = current_rss()
+    instrumentation = Instrumentation()
+    start = time.perf_counter()
+    grabcut = GrabCut(img, useCV=useCV, instrumentation=instrumentation, **options)
+    matte = grabcut.segment(default_rect(grabcut.imgShape, useCV), None)
+    total = time.perf_counter() - start
+    record = instrumentation.records[-1]
+    # ru_maxrss is in KB on Linux
+    queue.put({'shape': list(img.shape[:2]), 'total': total,
+               'phases': {name: phase['time'] for name, phase in record['phases'].items()},
+               'counters': record['counters'], 'series': record['series'],
+               'base_rss_mb': baseRSS, 'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+               'matte': matte})
+
+
+# Every run gets a fresh process so that its peak RSS is its own
+def run(imagePath, scale, useCV, options):
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=segment, args=(imagePath, scale, useCV, options, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+            'opencv': cv.__version__, 'maxflow': getattr(maxflow, '__version__', None),
+            'machine': platform.machine(), 'cpus': os.cpu_count()}
+
+
+# Runs slower than the baseline by more than tolerance (relative), by (image, scale, engine)
+def regressions(results, baseline, tolerance):
+    previous = {(r['image'], r['scale'], r['engine']): r for r in baseline['results']}
+    slower = []
+    for r in results:
+        old = previous.get((r['image'], r['scale'], r['engine']))
+        if old is not None and r['total'] > old['total'] * (1 + tolerance):
+            slower.append((r['image'], r['scale'], r['engine'], old['total'], r['total']))
+    return slower
+
+
+'''
+Benchmark both engines on the images of test/imgs at several scales with a fixed rect
+(10% margin), recording the time of every phase, the peak RSS and the IoU against OpenCV.
+e.g. python Benchmark.py --scales 0.5,1 --out bench.json --baseline previous.json
+'''
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='GrabCut benchmark, Python engine vs cv.grabCut')
+    parser.add_argument('--imgs', default=IMG_DIR)
+    parser.add_argument('--scales', default='0.5,1')
+    parser.add_argument('--iter', type=int, default=3)
+    parser.add_argument('--out', default='bench.json')
+    parser.add_argument('--baseline', default=None, help='JSON of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown')
+    args = parser.parse_args()
+
+    results = []
+    for imagePath in test_images(args.imgs):
+        for scale in [float(s) for s in args.scales.split(',')]:
+            ref = None
+            for engine, useCV in (('cv', True), ('python', False)):
+                result = run(imagePath, scale, useCV, {'iterCount': args.iter})
+                matte = result.pop('matte')
+                if useCV:
+                    ref = matte
+                result.update(image=os.path.basename(imagePath), scale=scale, engine=engine,
+                              foreground=float(matte.mean()), iou_vs_cv=iou(ref, matte))
+                results.append(result)
+                print("%s x%g %s: %.2fs, peak RSS %.0f MB, IoU %.3f %s" % (
+                    result['image'], scale, engine, result['total'], result['peak_rss_mb'], result['iou_vs_cv'],
+                    ' '.join('%s=%.2f' % phase for phase in result['phases'].items())))
+    with open(args.out, 'w') as f:
+        json.dump({'environment': environment(), 'iterCount': args.iter, 'results': results}, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = regressions(results, json.load(f), args.tolerance)
+        for image, scale, engine, old, new in slower:
+            print("REGRESSION %s x%g %s: %.2fs -> %.2fs" % (image, scale, engine, old, new))
+        sys.exit(1 if slower else 0)
@@ -0,0 +1,94 @@
+import numpy as np
+import cv2 as cv
+
+# Candidate centers (relative to the hard boundary) and widths of the alpha profile, in pixels
+SIGMAS = np.array([0.25, 0.5, 1., 1.5, 2.])
+# Floor of the local color variances, for flat regions
+MIN_VARIANCE = 4.
+
+
+def sigmoid(x):
+	return 1. / (1. + np.exp(-np.clip(x, -40., 40.)))
+
+
+'''
+Border matting in the spirit of GrabCut's (Rother et al. 2004): a soft alpha for the pixels
+within bandWidth of the hard matte's boundary, the rest of the matte is kept as it is.
+- Every contour point (foreground pixel with a background 4-neighbor) owns the band pixels
+nearer to it than to any other one, found through a disk stencil around each point.
+- Across the contour alpha is a sigmoid of the signed distance r to the boundary,
+alpha = sigmoid((r - delta) / sigma), with (delta, sigma) fitted per contour point by trying
+every candidate at once: the cost is the color residual of the point's band pixels against
+alpha*F + (1-alpha)*B, F and B the mean colors of the pure foreground and background pixels of
+its stencil, plus smoothness*(delta^2 + sigma^2) so that the hard edge wins where F and B
+do not tell the two apart.
+Only the stencil pixels of the contour points are read, so the cost is proportional to the
+boundary length times bandWidth^2, not to the image area (besides a 3x3 erosion of the matte).
+Returns the alpha matte, float32 in [0, 1], shape (h, w).
+'''
+def border_matting(img, matte, bandWidth=3, smoothness=1.):
+	if bandWidth < 1:
+		raise ValueError("bandWidth must be at least 1 pixel, got %r" % (bandWidth, ))
+	h, w = matte.shape
+	matte = np.ascontiguousarray(matte, np.uint8)
+	alpha = matte.astype(np.float32)
+	cross = cv.getStructuringElement(cv.MORPH_CROSS, (3, 3))
+	eroded = cv.erode(matte, cross).reshape(h*w)
+	dilated = cv.dilate(matte, cross).reshape(h*w)
+	flat = matte.reshape(h*w)
+	contour = np.flatnonzero(flat != eroded)
+	if len(contour) == 0:
+		return alpha
+	pixels = img.reshape(h*w, 3)
+
+	# Stencil pixels of every contour point, shape (points, stencil)
+	oy, ox = np.mgrid[-bandWidth:bandWidth + 1, -bandWidth:bandWidth + 1]
+	disk = oy**2 + ox**2 <= bandWidth**2
+	oy, ox = oy[disk], ox[disk]
+	y, x = np.divmod(contour, w)
+	y, x = y[:, np.newaxis] + oy, x[:, np.newaxis] + ox
+	valid = (y >= 0) & (y < h) & (x >= 0) & (x < w)
+	idx = np.where(valid, y*w + x, 0)
+	colors = pixels[idx].astype(np.float64)
+
+	# Mean and variance of the pure (not boundary) foreground and background colors around each point
+	def local_stats(select):
+		count = np.count_nonzero(select, axis=1)
+		mean = np.einsum('ij,ijk->ik', select, colors) / np.maximum(count, 1)[:, np.newaxis]
+		sq_dist = np.sum((colors - mean[:, np.newaxis])**2, axis=2)
+		var = np.einsum('ij,ij->i', select, sq_dist) / np.maximum(count, 1)
+		return mean, var, count > 0
+	F, varF, hasF = local_stats((valid & (eroded[idx] == 1)).astype(np.float64))
+	B, varB, hasB = local_stats((valid & (dilated[idx] == 0)).astype(np.float64))
+	var = np.maximum(0.5*(varF + varB), MIN_VARIANCE)
+
+	# Each band pixel goes to its nearest contour point, sorted by point
+	point = np.broadcast_to(np.arange(len(contour))[:, np.newaxis], idx.shape)[valid]
+	band, sq_dist = idx[valid], np.broadcast_to(oy**2 + ox**2, idx.shape)[valid]
+	order = np.lexsort((sq_dist, band))
+	first = np.ones(len(order), bool)
+	first[1:] = band[order[1:]] != band[order[:-1]]
+	order = order[first]
+	order = order[np.argsort(point[order], kind='stable')]
+	band, point, dist = band[order], point[order], np.sqrt(sq_dist[order])
+	# Signed distance to the boundary, which runs half a pixel outside the contour points
+	r = np.where(flat[band] == 1, dist + 0.5, 0.5 - dist)
+
+	# |z - (alpha*F + (1-alpha)*B)|^2 = a - 2*alpha*b + alpha^2*c
+	z = pixels[band].astype(np.float64)
+	fits = (hasF & hasB)[point]
+	zb, fb = z - B[point], F[point] - B[point]
+	a = np.where(fits, np.einsum('ij,ij->i', zb, zb), 0.) / var[point]
+	b = np.where(fits, np.einsum('ij,ij->i', zb, fb), 0.) / var[point]
+	c = np.where(fits, np.einsum('ij,ij->i', fb, fb), 0.) / var[point]
+
+	deltas, sigmas = np.meshgrid(np.arange(-bandWidth, bandWidth + 1) / 2., SIGMAS[SIGMAS <= bandWidth])
+	deltas, sigmas = deltas.reshape(-1), sigmas.reshape(-1)
+	candidates = sigmoid((r[:, np.newaxis] - deltas) / sigmas)
+	cost = a[:, np.newaxis] - 2*candidates*b[:, np.newaxis] + candidates**2*c[:, np.newaxis]
+	# Every contour point owns at least itself, so the groups are the points in order
+	starts = np.flatnonzero(np.r_[True, point[1:] != point[:-1]])
+	cost = np.add.reduceat(cost, starts, axis=0) + smoothness*(deltas**2 + sigmas**2)
+	best = np.argmin(cost, axis=1)[point]
+	alpha.reshape(h*w)[band] = sigmoid((r - deltas[best]) / sigmas[best])
+	return alpha
@@ -0,0 +1,155 @@
+import numpy as np
+import cv2 as cv
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import maximum_flow, breadth_first_order
+
+# PyMaxflow is optional, the scipy backend only needs scipy
+try:
+	import maxflow
+except ImportError:
+	maxflow = None
+
+INT32_MAX = np.iinfo(np.int32).max
+
+
+def require_maxflow():
+	if maxflow is None:
+		raise ImportError("PyMaxflow is not installed, use the 'scipy' backend")
+	return maxflow
+
+
+'''
+Min-cut solvers of a GCGraph. solve(graph) reads the graph's precomputed capacities:
+graph.N_links() as (dx, dy, weights) with weights[y, x] the capacity between (x, y) and
+(x+dx, y+dy), graph.bgd_w and graph.fgd_w the source (BGD) and sink (FGD) capacities, shape
+(h, w), and graph.mask the trimap. It returns the labels, shape (h*w, ), 0 on the source (BGD)
+side, and the flow. Incremental backends also build a graph that GCGraph keeps and updates
+between cuts (reuseGraph, GrabCutSession).
+'''
+class PyMaxflowBackend(object):
+	name = 'pymaxflow'
+	incremental = True
+
+	def build(self, graph):
+		g = require_maxflow().Graph[float](graph.N, graph.edge_nums)
+		nodeids = g.add_grid_nodes((graph.h, graph.w))
+		reach = max(max(abs(dx), dy) for dx, dy, _ in graph.N_links())
+		for dx, dy, weights in graph.N_links():
+			structure = np.zeros((2*reach + 1, 2*reach + 1))
+			structure[reach + dy, reach + dx] = 1
+			g.add_grid_edges(nodeids, weights=weights, structure=structure, symmetric=True)
+		g.add_grid_tedges(nodeids, graph.bgd_w, graph.fgd_w)
+		return g, nodeids
+
+	def solve(self, graph):
+		g, nodeids = self.build(graph)
+		flow = g.maxflow()
+		return g.get_grid_segments(nodeids).reshape(graph.N).astype(np.uint8), flow
+
+
+class ScipyBackend(object):
+	'''
+	scipy.sparse.csgraph.maximum_flow (Dinic) on a CSR graph of the UKN pixels only: the links
+	of a UKN pixel to fixed neighbors are folded into its T-links and only the difference of
+	its two T-links is kept, which gives the same cut. maximum_flow takes int32 capacities, so
+	they are scaled so that the flow fits, a relative precision of about 1e-9 of the total flow.
+	'''
+	name = 'scipy'
+	incremental = False
+
+	def __init__(self, method='dinic'):
+		self.method = method
+
+	def solve(self, graph):
+		from GCGraph import Trimap
+		h, w = graph.h, graph.w
+		mask = graph.mask.reshape(h, w)
+		labels = (mask == Trimap.FGD).astype(np.uint8)
+		free = mask == Trimap.UKN
+		n = int(np.count_nonzero(free))
+		if n == 0:
+			return labels.reshape(graph.N), 0.
+		node = np.full((h, w), -1, np.int64)
+		node[free] = np.arange(n)
+		bgd_w, fgd_w = graph.bgd_w[free], graph.fgd_w[free]
+		rows, cols, caps = [], [], []
+		for dx, dy, weights in graph.N_links():
+			x1, x2 = max(0, -dx), w - max(0, dx)
+			p, q = node[0:h-dy, x1:x2], node[dy:h, x1+dx:x2+dx]
+			mask_p, mask_q = mask[0:h-dy, x1:x2], mask[dy:h, x1+dx:x2+dx]
+			c = weights[0:h-dy, x1:x2]
+			both = (p >= 0) & (q >= 0)
+			rows += [p[both], q[both]]
+			cols += [q[both], p[both]]
+			caps += [c[both], c[both]]
+			# Each pixel has one neighbor per direction, so the indices do not repeat
+			for a, neighbor in ((p, mask_q), (q, mask_p)):
+				fixed = (a >= 0) & (neighbor == Trimap.BGD)
+				bgd_w[a[fixed]] += c[fixed]
+				fixed = (a >= 0) & (neighbor == Trimap.FGD)
+				fgd_w[a[fixed]] += c[fixed]
+		source, sink = n, n + 1
+		t = bgd_w - fgd_w
+		# A model learned from no pixels gives infinite T-links, any capacity over the whole
+		# graph's is as hard and keeps the scaling finite
+		t[np.isnan(t)] = 0.
+		infinite = np.isinf(t)
+		if infinite.any():
+			hard = 1 + np.abs(t[~infinite]).sum() + sum(c.sum() for c in caps)
+			t[infinite] = np.sign(t[infinite]) * hard
+		to_source, to_sink = np.flatnonzero(t > 0), np.flatnonzero(t < 0)
+		rows += [np.full(len(to_source), source), to_sink]
+		cols += [to_source, np.full(len(to_sink), sink)]
+		caps += [t[to_source], -t[to_sink]]
+		caps = np.concatenate(caps)
+		bound = max(min(t[to_source].sum(), -t[to_sink].sum()), caps.max(initial=0.), 1e-12)
+		scale = 0.5 * INT32_MAX / bound
+		capacity = csr_matrix((np.round(caps * scale).astype(np.int32), (np.concatenate(rows), np.concatenate(cols))),
+							  shape=(n + 2, n + 2))
+		result = maximum_flow(capacity, source, sink, method=self.method)
+		# Source side: reachable from the source in the residual graph
+		residual = csr_matrix(capacity - result.flow)
+		residual.data[residual.data < 0] = 0
+		residual.eliminate_zeros()
+		reachable = breadth_first_order(residual, source, directed=True, return_predecessors=False)
+		side = np.ones((n + 2, ), np.uint8)
+		side[reachable] = 0
+		labels[free] = side[:n]
+		return labels.reshape(graph.N), result.flow_value / scale + np.minimum(bgd_w, fgd_w).sum()
+
+
+class OpenCVBackend(object):
+	'''
+	OpenCV's own graph cut, through cv.grabCut with the GMMs frozen. OpenCV does not take
+	capacities, it recomputes the same energy from the image, the trimap and the models:
+	8-connected N-links with gamma fixed at 50 and beta of the image, so it needs gamma=50,
+	5 components and neighborhood=8, and does not see a beta given to GCGraph (e.g. by tiles).
+	'''
+	name = 'opencv'
+	incremental = False
+
+	def solve(self, graph):
+		from GCGraph import Trimap
+		if graph.gamma != 50:
+			raise ValueError("OpenCV's graph cut has gamma fixed at 50")
+		if graph.neighborhood != 8:
+			raise ValueError("OpenCV's graph cut is 8-connected")
+		mask = graph.mask.reshape(graph.h, graph.w)
+		cv_mask = np.full(mask.shape, cv.GC_PR_FGD, np.uint8)
+		cv_mask[mask == Trimap.BGD] = cv.GC_BGD
+		cv_mask[mask == Trimap.FGD] = cv.GC_FGD
+		cv.grabCut(np.ascontiguousarray(graph.img), cv_mask, None, graph.bgdModel.to_cv(), graph.fgdModel.to_cv(),
+				   1, cv.GC_EVAL_FREEZE_MODEL)
+		labels = (cv_mask == cv.GC_FGD) | (cv_mask == cv.GC_PR_FGD)
+		return labels.reshape(graph.N).astype(np.uint8), float('nan')
+
+
+BACKENDS = {backend.name: backend for backend in (PyMaxflowBackend, ScipyBackend, OpenCVBackend)}
+DEFAULT_BACKEND = 'pymaxflow' if maxflow is not None else 'scipy'
+
+
+def get_backend(name=None):
+	name = name or DEFAULT_BACKEND
+	if name not in BACKENDS:
+		raise ValueError("Unknown max-flow backend: " + name)
+	return BACKENDS[name]()
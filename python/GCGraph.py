@@ -1,11 +1,9 @@
 from enum import IntEnum
 
 import numpy as np
-from scipy.spatial.distance import euclidean
-from scipy.sparse import csr_matrix
-from scipy.sparse.csgraph import maximum_flow
 import cv2 as cv
-import maxflow
+from CutBackends import get_backend, require_maxflow
+from Instrumentation import NULL_INSTRUMENTATION, timeit
 
 class Trimap(IntEnum):
 	BGD = 0
@@ -13,71 +11,444 @@ class Trimap(IntEnum):
 	UKN = 2
 
 
+# Forward (dx, dy) offsets of the 4, 8 and 16-connected neighborhoods, each pair of
+# neighbors is linked once through the offset with dy > 0, or dy == 0 and dx > 0
+NEIGHBORHOODS = {
+	4: ((1, 0), (0, 1)),
+	8: ((1, 0), (-1, 1), (0, 1), (1, 1)),
+	16: ((1, 0), (-1, 1), (0, 1), (1, 1), (2, 1), (1, 2), (-1, 2), (-2, 1)),
+}
+
+
+def neighborhood_offsets(neighborhood):
+	if neighborhood not in NEIGHBORHOODS:
+		raise ValueError("Neighborhood must be 4, 8 or 16, not %s" % neighborhood)
+	return NEIGHBORHOODS[neighborhood]
+
+
+# N-link weight of each offset relative to gamma, so that cut costs approximate the Euclidean
+# boundary length (Boykov & Kolmogorov 2003): the angle between the neighboring directions of
+# the offset's direction, over its length. Normalized so that 8-connectivity gives the usual
+# gamma/dist of GrabCut, i.e. 1 and 1/sqrt(2).
+def neighbor_weights(offsets):
+	angles = np.arctan2([dy for dx, dy in offsets], [dx for dx, dy in offsets])
+	around = np.sort(np.concatenate((angles, angles - np.pi)))
+	around = np.concatenate((around[-1:] - 2*np.pi, around, around[:1] + 2*np.pi))
+	weights = []
+	for (dx, dy), angle in zip(offsets, angles):
+		i = np.searchsorted(around, angle - 1e-9)
+		weights.append((around[i+1] - around[i-1]) / 2 / (np.pi/4) / np.hypot(dx, dy))
+	return np.array(weights)
+
+
+# Number of neighbor pairs of an h x w image, the exact number of N-link edges
+def edge_count(h, w, offsets):
+	return sum(max(0, h - dy) * max(0, w - abs(dx)) for dx, dy in offsets)
+
+
+# Zero the N-link weights, shape (offsets, h, w), of the neighbors outside the image
+def drop_outside_links(weights, offsets):
+	h, w = weights.shape[1:]
+	for (dx, dy), plane in zip(offsets, weights):
+		plane[h-dy:] = 0
+		plane[:, :max(0, -dx)] = 0
+		plane[:, w-max(0, dx):] = 0
+
+
+# Squared color distance between each pixel and its neighbor at (x+dx, y+dy), written
+# to out if given, zero where the neighbor falls outside the image. Also returns the
+# number of such pairs.
+def neighbor_sq_dist(img, dx, dy, out=None):
+	h, w = img.shape[:2]
+	sq_dist = np.zeros((h, w)) if out is None else out
+	x1, x2 = max(0, -dx), w - max(0, dx)
+	src = img[0:h-dy, x1:x2]
+	dst = img[dy:h, x1+dx:x2+dx]
+	if out is not None:
+		sq_dist[h-dy:] = 0
+		sq_dist[:, :x1] = 0
+		sq_dist[:, x2:] = 0
+	sq_dist[0:h-dy, x1:x2] = np.sum((src - dst)**2, axis=2)
+	return sq_dist, src.shape[0]*src.shape[1]
+
+
+# Same beta as GCGraph.calculate_beta, computed on strips of rows so that
+# the whole image never has to be converted to float at once
+def image_beta(img, offsets, rows=256):
+	h = img.shape[0]
+	reach = max(dy for dx, dy in offsets)
+	dist, num = 0., 0
+	for y1 in range(0, h, rows):
+		y2 = min(y1 + rows, h)
+		# Extra rows for the links leaving the strip downwards
+		strip = np.asarray(img[y1:min(y2 + reach, h)], np.float64)
+		for dx, dy in offsets:
+			sq_dist, _ = neighbor_sq_dist(strip, dx, dy)
+			dist += np.sum(sq_dist[:y2 - y1])
+			num += max(0, min(y2 - y1, len(strip) - dy)) * (img.shape[1] - abs(dx))
+	return 0.5/(dist/num)
+
+
 class GCGraph(object):
-	def __init__(self, img, gamma=50):
+	# beta is computed from img unless given, e.g. the beta of the whole image for a tile.
+	# With a ColorTable of img the GMMs are evaluated once per color of the table.
+	# backend is the name of the min-cut solver, see CutBackends.
+	# neighborhood is the connectivity of the N-links: 4, 8 or 16.
+	# weights are precomputed N-link weights of img with beta, see crop.
+	def __init__(self, img, gamma=50, beta=None, table=None, instrumentation=None, backend=None, neighborhood=8,
+				 weights=None):
+		self.instrumentation = instrumentation or NULL_INSTRUMENTATION
+		self.backend = get_backend(backend)
 		self.img = img
+		self.table = table
 		self.gamma = gamma
-		self.beta = 0
+		self.beta = beta
 		self.h, self.w = img.shape[:2]
 		self.N = self.w * self.h
 		self.pixels = self.img.reshape(self.N, 3)
-		self.edge_nums = self.N*10 - 6*(self.w + self.h - 4) - 20
-		self.largest_weight = 9*self.gamma
-		self.dx = np.array([1, -1, 0, 1]).astype(np.uint8)
-		self.dy = np.array([0, 1, 1, 1]).astype(np.uint8)
+		self.neighborhood = neighborhood
+		self.offsets = neighborhood_offsets(neighborhood)
+		self.edge_nums = edge_count(self.h, self.w, self.offsets)
+		# Hard constraints must outweigh all the N-links of a pixel, 9*gamma always does
+		# for these neighborhoods (8*gamma for 4-connectivity is the largest sum)
+		self.largest_weight = max(9*self.gamma, 1 + 2*self.gamma*neighbor_weights(self.offsets).sum())
+		# Graph of an incremental backend, kept between cuts
 		self.graph = None
-		self.calculate_beta()
+		self.nodeids = None
+		self.mask = None
+		self.bgdModel = None
+		self.fgdModel = None
+		# T-link capacities currently in self.graph, see update_graph
+		self.bgd_w = None
+		self.fgd_w = None
+		# N-link capacities, weights[i, y, x] links (x, y) to (x, y) + offsets[i], see init_N_links
+		self.weights = weights
+		if weights is None:
+			self.calculate_beta()
+		else:
+			self.instrumentation.count('beta', self.beta)
 
 	def to_1D_coord(self, x, y):
 		return y*self.w + x
 
+	# Computes beta and the N-link weights for every direction in a single pass
+	# over the image. Both only depend on the image so they are kept for every build_graph.
 	def calculate_beta(self):
-		w, h, img = self.w, self.h, self.img
+		img = self.img.astype(np.float64)
 		dist, num = 0., 0
-		for y1 in range(h):
-			for x1 in range(w):
-				for k in range(4):
-					x2, y2 = x1 + self.dx[k], y1 + self.dy[k]
-					if 0 <= x2 < w and 0 <= y2 < h:
-						diff = img[y1, x1] - img[y2, x2]
-						dist += np.dot(diff, diff.T)
-						num += 1
-		self.beta = 0.5/(dist/num)
-		print("beta:", self.beta)
-		
+		# One contiguous (h, w) plane per offset, the squared distances become the weights
+		self.weights = np.empty((len(self.offsets), self.h, self.w))
+		for (dx, dy), sq_dist in zip(self.offsets, self.weights):
+			_, n = neighbor_sq_dist(img, dx, dy, sq_dist)
+			dist += np.sum(sq_dist)
+			num += n
+		if self.beta is None:
+			self.beta = 0.5/(dist/num)
+		self.instrumentation.count('beta', self.beta)
+		self.init_N_links()
 
 	def init_N_links(self):
-		w, h, img = self.w, self.h, self.img
-		for y1 in range(h):
-			for x1 in range(w):
-				s = self.to_1D_coord(x1, y1)
-				for k in range(4):
-					x2, y2 = x1 + self.dx[k], y1 + self.dy[k]
-					if 0 <= x2 < w and 0 <= y2 < h:
-						t = self.to_1D_coord(x2, y2)
-						diff = img[y1, x1] - img[y2, x2]
-						weight = self.gamma / euclidean((x1, y1), (x2, y2)) * np.exp(-self.beta * np.dot(diff, diff.T))
-						self.graph.add_edge(s, t, weight, weight)
-						# print("n-links: ", s, t, weight)
+		self.weights *= -self.beta
+		np.exp(self.weights, out=self.weights)
+		for weights, scale in zip(self.weights, neighbor_weights(self.offsets)):
+			weights *= self.gamma * scale
+		drop_outside_links(self.weights, self.offsets)
+
+	# GCGraph of the region [y1:y2, x1:x2] of the image with its beta and N-link weights,
+	# without the links leaving the region
+	def crop(self, y1, y2, x1, x2, instrumentation=None):
+		weights = self.weights[:, y1:y2, x1:x2].copy()
+		drop_outside_links(weights, self.offsets)
+		return GCGraph(np.ascontiguousarray(self.img[y1:y2, x1:x2]), self.gamma, self.beta,
+					   instrumentation=instrumentation, backend=self.backend.name, neighborhood=self.neighborhood,
+					   weights=weights)
 
+	# (dx, dy, weights) of every neighbor direction
+	def N_links(self):
+		return [(dx, dy, weights) for (dx, dy), weights in zip(self.offsets, self.weights)]
+
+	@timeit
 	def build_graph(self, mask, bgdModel, fgdModel):
-		self.graph = maxflow.Graph[float](self.N, self.edge_nums)
-		self.graph.add_nodes(self.N)
-		self.init_N_links()
-		# Add T-links
-		for i in range(self.N):
-			if mask[i] == Trimap.BGD:
-				bgd_w, fgd_w = self.largest_weight, 0
-			elif mask[i] == Trimap.FGD:
-				bgd_w, fgd_w = 0, self.largest_weight
-			else:
-				bgd_w, fgd_w = -np.log(bgdModel.model_likelihood(self.pixels[i])), -np.log(fgdModel.model_likelihood(self.pixels[i]))
-				# print("t-links: ", i, bgd_w, fgd_w)
-			self.graph.add_tedge(i, bgd_w, fgd_w)
+		self.mask = mask
+		self.bgdModel, self.fgdModel = bgdModel, fgdModel
+		self.bgd_w, self.fgd_w = self.T_links(mask, bgdModel, fgdModel)
+		self.instrumentation.count('nodes', self.N)
+		if not self.backend.incremental:
+			return
+		self.graph, self.nodeids = self.backend.build(self)
+		self.instrumentation.count('edges', self.graph.get_edge_count())
+
+	# Reuse the graph of the previous cut: N-links never change, so only the T-links
+	# whose capacity changed are updated and marked for the next cut(reuse_trees=True)
+	@timeit
+	def update_graph(self, mask, bgdModel, fgdModel):
+		bgd_w, fgd_w = self.T_links(mask, bgdModel, fgdModel)
+		idx = np.flatnonzero((bgd_w != self.bgd_w) | (fgd_w != self.fgd_w))
+		self.set_T_links(idx, bgd_w.reshape(self.N)[idx], fgd_w.reshape(self.N)[idx])
+		self.instrumentation.append('updated_T_links', len(idx))
+		return len(idx)
+
+	# Hard-constrain the pixels at 1D indices idx to their BGD/FGD labels
+	def clamp_T_links(self, idx, labels):
+		bgd_w = np.where(labels == Trimap.BGD, self.largest_weight, 0.)
+		fgd_w = np.where(labels == Trimap.FGD, self.largest_weight, 0.)
+		self.set_T_links(idx, bgd_w, fgd_w)
+
+	# Set the T-links of the pixels at 1D indices idx by adding the capacity deltas
+	def set_T_links(self, idx, bgd_w, fgd_w):
+		nodes = self.nodeids.reshape(self.N)[idx]
+		old_bgd_w, old_fgd_w = self.bgd_w.reshape(self.N), self.fgd_w.reshape(self.N)
+		self.graph.add_grid_tedges(nodes, bgd_w - old_bgd_w[idx], fgd_w - old_fgd_w[idx])
+		self.graph.mark_grid_nodes(nodes)
+		old_bgd_w[idx] = bgd_w
+		old_fgd_w[idx] = fgd_w
+
+	# Source (bgd) and sink (fgd) capacities of every pixel, shape (h, w).
+	# Only UKN pixels need their GMM likelihoods evaluated.
+	def T_links(self, mask, bgdModel, fgdModel):
+		mask = mask.reshape(self.h, self.w)
+		bgd_w = np.zeros((self.h, self.w))
+		fgd_w = np.zeros((self.h, self.w))
+		bgd_w[mask == Trimap.BGD] = self.largest_weight
+		fgd_w[mask == Trimap.FGD] = self.largest_weight
+		ukn = mask == Trimap.UKN
+		if self.table is not None:
+			ukn = ukn.reshape(self.N)
+			bgd_w.reshape(self.N)[ukn] = -self.table.lookup(fgdModel.model_log_likelihood, ukn)
+			fgd_w.reshape(self.N)[ukn] = -self.table.lookup(bgdModel.model_log_likelihood, ukn)
+			return bgd_w, fgd_w
+		ukn_pixels = self.img[ukn]
+		bgd_w[ukn] = -fgdModel.model_log_likelihood(ukn_pixels)
+		fgd_w[ukn] = -bgdModel.model_log_likelihood(ukn_pixels)
+		return bgd_w, fgd_w
+
+	def cut(self, reuse_trees=False):
+		if self.graph is None:
+			with self.instrumentation.phase('maxflow'):
+				alpha, flow = self.backend.solve(self)
+			self.instrumentation.append('maxflow', flow)
+			return alpha
+		with self.instrumentation.phase('maxflow'):
+			flow = self.graph.maxflow(reuse_trees)
+		self.instrumentation.append('maxflow', flow)
+		return self.graph.get_grid_segments(self.nodeids).reshape(self.N).astype(np.uint8)
+
+
+class BandGCGraph(object):
+	'''
+	GCGraph with nodes for the UKN pixels only, for trimaps where they are a narrow band.
+	The N-links between a UKN pixel and a fixed neighbor are folded into the UKN pixel's
+	T-links, which gives the same cut since fixed pixels never change label (their T-link,
+	largest_weight, is more than all of their N-links together). N-links are only computed
+	for the band, so beta should be given when cutting many frames of the same scene.
+	'''
+	def __init__(self, img, gamma=50, beta=None, instrumentation=None, neighborhood=8):
+		# Only PyMaxflow takes an arbitrary graph, fail before any work
+		require_maxflow()
+		self.instrumentation = instrumentation or NULL_INSTRUMENTATION
+		self.img = img
+		self.gamma = gamma
+		self.h, self.w = img.shape[:2]
+		self.N = self.w * self.h
+		self.pixels = self.img.reshape(self.N, 3)
+		self.neighborhood = neighborhood
+		self.offsets = neighborhood_offsets(neighborhood)
+		self.scales = self.gamma * neighbor_weights(self.offsets)
+		self.largest_weight = max(9*self.gamma, 1 + 2*self.scales.sum())
+		self.beta = image_beta(img, self.offsets) if beta is None else beta
+		self.instrumentation.count('beta', self.beta)
+		self.graph = None
+		self.mask = None
+		self.ukn = None
+
+	@timeit
+	def build_graph(self, mask, bgdModel, fgdModel):
+		self.mask = mask.reshape(self.N)
+		self.ukn = np.flatnonzero(self.mask == Trimap.UKN)
+		n = len(self.ukn)
+		self.instrumentation.count('nodes', n)
+		if n == 0:
+			# Nothing to cut, e.g. a matte covering the whole frame
+			self.graph = None
+			return
+		node = np.full((self.N, ), -1, np.int64)
+		node[self.ukn] = np.arange(n)
+		ukn_pixels = np.take(self.pixels, self.ukn, axis=0)
+		bgd_w = -fgdModel.model_log_likelihood(ukn_pixels)
+		fgd_w = -bgdModel.model_log_likelihood(ukn_pixels)
+		ukn_pixels = ukn_pixels.astype(np.float64)
+		x, y = self.ukn % self.w, self.ukn // self.w
+		self.graph = require_maxflow().Graph[float](n, len(self.offsets)*n)
+		self.graph.add_nodes(n)
+		for (dx, dy), scale in zip(self.offsets, self.scales):
+			# Both neighbors along this direction, each pair of UKN pixels is linked once
+			for sign in (1, -1):
+				inside = np.flatnonzero((x + sign*dx >= 0) & (x + sign*dx < self.w) & (y + sign*dy < self.h) & (y + sign*dy >= 0))
+				q = self.ukn[inside] + sign*(dy*self.w + dx)
+				diff = ukn_pixels[inside] - np.take(self.pixels, q, axis=0)
+				weights = np.einsum('ij,ij->i', diff, diff)
+				weights *= -self.beta
+				np.exp(weights, out=weights)
+				weights *= scale
+				neighbor = node[q]
+				if sign == 1:
+					linked = neighbor >= 0
+					self.graph.add_edges(inside[linked], neighbor[linked], weights[linked], weights[linked])
+				# Being cut from a fixed neighbor costs its N-link, inside has no repeats
+				labels = self.mask[q]
+				bgd_w[inside] += np.where(labels == Trimap.BGD, weights, 0.)
+				fgd_w[inside] += np.where(labels == Trimap.FGD, weights, 0.)
+		self.graph.add_grid_tedges(np.arange(n), bgd_w, fgd_w)
+		self.instrumentation.count('edges', self.graph.get_edge_count())
+
+	def cut(self, reuse_trees=False):
+		alpha = (self.mask == Trimap.FGD).astype(np.uint8)
+		if self.graph is None:
+			return alpha
+		with self.instrumentation.phase('maxflow'):
+			flow = self.graph.maxflow(reuse_trees)
+		self.instrumentation.append('maxflow', flow)
+		alpha[self.ukn] = self.graph.get_grid_segments(np.arange(len(self.ukn)))
+		return alpha
+
+
+# N-links between the regions of labels (shape (h, w), values 0..count-1): the pixel N-links
+# across the boundary of every two adjacent regions, summed. Computed on strips of rows like
+# image_beta. Returns the two regions of each link and its weight.
+def region_N_links(img, labels, count, beta, offsets, scales, rows=256):
+	h, w = labels.shape
+	reach = max(dy for dx, dy in offsets)
+	keys, weights = [], []
+	for y1 in range(0, h, rows):
+		y2 = min(y1 + rows, h)
+		strip = np.asarray(img[y1:min(y2 + reach, h)], np.float64)
+		regions = labels[y1:min(y2 + reach, h)]
+		for (dx, dy), scale in zip(offsets, scales):
+			n = min(y2 - y1, len(strip) - dy)
+			if n <= 0:
+				continue
+			x1, x2 = max(0, -dx), w - max(0, dx)
+			p, q = regions[:n, x1:x2], regions[dy:dy+n, x1+dx:x2+dx]
+			across = p != q
+			diff = strip[:n, x1:x2][across] - strip[dy:dy+n, x1+dx:x2+dx][across]
+			weights.append(scale * np.exp(-beta * np.einsum('ij,ij->i', diff, diff)))
+			p, q = p[across].astype(np.int64), q[across].astype(np.int64)
+			keys.append(np.minimum(p, q) * count + np.maximum(p, q))
+	keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+	return keys // count, keys % count, np.bincount(inverse, np.concatenate(weights))
+
+
+class RegionGCGraph(object):
+	'''
+	GCGraph on the regions of an oversegmentation (see Superpixels) instead of pixels, a node per
+	region. A region's T-links sum the data costs of its pixels, and two adjacent regions are linked
+	by the sum of the pixel N-links across their boundary, i.e. their boundary length weighted by its
+	contrast. A labelling of the regions then costs the same as the pixel labelling it maps to, so
+	the cut is GCGraph's restricted to labellings constant on every region, on a graph the size of
+	the region count. Regions must not mix trimap labels. mask, bgd_w and fgd_w are per region.
+	'''
+	def __init__(self, img, labels, count, gamma=50, beta=None, instrumentation=None, neighborhood=8):
+		# Only PyMaxflow takes an arbitrary graph, fail before any work
+		require_maxflow()
+		self.instrumentation = instrumentation or NULL_INSTRUMENTATION
+		self.img = img
+		self.gamma = gamma
+		self.h, self.w = img.shape[:2]
+		self.N = self.w * self.h
+		self.pixels = img.reshape(self.N, 3)
+		self.labels = labels.reshape(self.N)
+		self.count = count
+		self.neighborhood = neighborhood
+		offsets = neighborhood_offsets(neighborhood)
+		self.beta = image_beta(img, offsets) if beta is None else beta
+		self.instrumentation.count('beta', self.beta)
+		with self.instrumentation.phase('region_N_links'):
+			self.edges = region_N_links(img, labels, count, self.beta, offsets, gamma * neighbor_weights(offsets))
+		p, q, weights = self.edges
+		# Hard constraints outweigh all the N-links of their region
+		self.largest_weight = 1 + np.bincount(p, weights, count) + np.bincount(q, weights, count)
+		self.instrumentation.count('regions', count)
+		self.graph = None
+		self.mask = None
+
+	@timeit
+	def build_graph(self, mask, bgdModel, fgdModel):
+		self.mask = mask
+		bgd_w = np.where(mask == Trimap.BGD, self.largest_weight, 0.)
+		fgd_w = np.where(mask == Trimap.FGD, self.largest_weight, 0.)
+		# Data costs of the UKN pixels, summed over their regions
+		ukn = np.flatnonzero(mask[self.labels] == Trimap.UKN)
+		regions, ukn_pixels = self.labels[ukn], np.take(self.pixels, ukn, axis=0)
+		bgd_w += np.bincount(regions, -fgdModel.model_log_likelihood(ukn_pixels), self.count)
+		fgd_w += np.bincount(regions, -bgdModel.model_log_likelihood(ukn_pixels), self.count)
+		p, q, weights = self.edges
+		self.graph = require_maxflow().Graph[float](self.count, len(weights))
+		self.graph.add_nodes(self.count)
+		self.graph.add_edges(p, q, weights, weights)
+		self.graph.add_grid_tedges(np.arange(self.count), bgd_w, fgd_w)
+		self.instrumentation.count('nodes', self.count)
+		self.instrumentation.count('edges', self.graph.get_edge_count())
+
+	# Labels of the regions, shape (count, )
+	def cut(self, reuse_trees=False):
+		with self.instrumentation.phase('maxflow'):
+			flow = self.graph.maxflow(reuse_trees)
+		self.instrumentation.append('maxflow', flow)
+		return self.graph.get_grid_segments(np.arange(self.count)).astype(np.uint8)
+
+
+class TiledGCGraph(object):
+	'''
+	Memory-bounded replacement of GCGraph for large images: the cut is solved on
+	tiles of tileSize x tileSize pixels, each padded by overlap pixels of context on
+	every side, and only the tile's own labels are kept. Only one tile's graph is
+	alive at a time and tiles without UKN pixels are not solved at all, so with a
+	band-shaped trimap only the tiles crossing the band are built.
+	All tiles share the beta of the whole image.
+	'''
+	def __init__(self, img, gamma=50, tileSize=1024, overlap=32, instrumentation=None, backend=None, neighborhood=8):
+		self.instrumentation = instrumentation or NULL_INSTRUMENTATION
+		self.backend = backend
+		self.img = img
+		self.gamma = gamma
+		self.h, self.w = img.shape[:2]
+		self.N = self.w * self.h
+		self.tileSize = tileSize
+		self.overlap = overlap
+		self.neighborhood = neighborhood
+		# Graphs are never kept between cuts
+		self.graph = None
+		self.mask = None
+		self.bgdModel = None
+		self.fgdModel = None
+		self.beta = image_beta(img, neighborhood_offsets(neighborhood))
+		self.instrumentation.count('beta', self.beta)
+
+	def tiles(self):
+		for y1 in range(0, self.h, self.tileSize):
+			for x1 in range(0, self.w, self.tileSize):
+				yield y1, min(y1 + self.tileSize, self.h), x1, min(x1 + self.tileSize, self.w)
+
+	def build_graph(self, mask, bgdModel, fgdModel):
+		self.mask = mask.reshape(self.h, self.w)
+		self.bgdModel, self.fgdModel = bgdModel, fgdModel
 
 	def cut(self):
-		self.graph.maxflow()
-		return np.array([self.graph.get_segment(i) for i in range(self.N)]).astype(np.uint8)
+		alpha = (self.mask == Trimap.FGD).astype(np.uint8)
+		solved = 0
+		for y1, y2, x1, x2 in self.tiles():
+			if not np.any(self.mask[y1:y2, x1:x2] == Trimap.UKN):
+				continue
+			solved += 1
+			py1, py2 = max(0, y1 - self.overlap), min(self.h, y2 + self.overlap)
+			px1, px2 = max(0, x1 - self.overlap), min(self.w, x2 + self.overlap)
+			tile = GCGraph(np.ascontiguousarray(self.img[py1:py2, px1:px2]), self.gamma, self.beta,
+						   instrumentation=self.instrumentation, backend=self.backend, neighborhood=self.neighborhood)
+			tile.build_graph(self.mask[py1:py2, px1:px2], self.bgdModel, self.fgdModel)
+			labels = tile.cut().reshape(py2 - py1, px2 - px1)
+			alpha[y1:y2, x1:x2] = labels[y1 - py1:y2 - py1, x1 - px1:x2 - px1]
+		self.instrumentation.append('tiles_solved', solved)
+		return alpha.reshape(self.N)
 
 
 if __name__ == '__main__':
@@ -1,29 +1,250 @@
-from sklearn.mixture import GaussianMixture
+import struct
+import hashlib
+from collections import OrderedDict
 import numpy as np
+import cv2 as cv
+from Instrumentation import NULL_INSTRUMENTATION, timeit
 
 EPS = 1e-6
 SINGULAR_FIX = 0.01
+# Pixels evaluated at once by the batched likelihoods, bounds their (N, K) temporaries
+CHUNK_SIZE = 1 << 18
+# Lloyd iterations of the k-means++ initializer
+KMEANS_ITERS = 10
+INIT_METHODS = ('kmeans++', 'cv', 'sklearn')
+# Serialized model: magic, K, then float64 weights, means and the upper triangles of the covariances
+MODEL_HEADER = struct.Struct('<4sH')
+MODEL_MAGIC = b'GMM1'
+TRIU = np.triu_indices(3)
+# Subtracted from the colors before accumulating their sums of squares in learn
+COLOR_CENTER = 127.5
+# OpenCV's models are 1x65 arrays of 5 components: weights, then means, then 3x3 covariances
+CV_COMPONENTS = 5
+
+
+# Index of the nearest center of every pixel
+def nearest_centers(pixels, centers):
+	out = np.empty((len(pixels), ), np.uint8)
+	for i in range(0, len(pixels), CHUNK_SIZE):
+		x = np.asarray(pixels[i:i+CHUNK_SIZE], np.float64)
+		# |x - c|^2 without the |x|^2 term, which is the same for every center
+		out[i:i+CHUNK_SIZE] = np.argmin(np.sum(centers**2, axis=1) - 2 * x @ centers.T, axis=1)
+	return out
+
+
+def kmeans_pp(samples, K, rng):
+	centers = np.empty((K, 3))
+	centers[0] = samples[rng.integers(len(samples))]
+	d2 = np.sum((samples - centers[0])**2, axis=1)
+	for k in range(1, K):
+		total = d2.sum()
+		i = rng.choice(len(samples), p=d2/total) if total > 0 else rng.integers(len(samples))
+		centers[k] = samples[i]
+		d2 = np.minimum(d2, np.sum((samples - centers[k])**2, axis=1))
+	for _ in range(KMEANS_ITERS):
+		labels = nearest_centers(samples, centers)
+		counts = np.bincount(labels, minlength=K)
+		sums = np.stack([np.bincount(labels, samples[:, c], minlength=K) for c in range(3)], axis=1)
+		# Empty clusters keep their center
+		new_centers = np.where(counts[:, np.newaxis] > 0, sums / np.maximum(counts, 1)[:, np.newaxis], centers)
+		if np.allclose(new_centers, centers):
+			break
+		centers = new_centers
+	return centers
+
+
+def cv_kmeans(samples, K, seed):
+	cv.setRNGSeed(seed)
+	criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, KMEANS_ITERS, 1.0)
+	_, _, centers = cv.kmeans(samples.astype(np.float32), K, None, criteria, 1, cv.KMEANS_PP_CENTERS)
+	return centers.astype(np.float64)
+
+
+# Multiple of SINGULAR_FIX to add to the diagonal of each covariance (K, 3, 3) so that its
+# determinant reaches EPS, i.e. the number of times SINGULAR_FIX would be added one at a time.
+# det(cov + t*I) = prod(eig + t) is increasing in t >= 0, so t is the largest real root of
+# t**3 + e1*t**2 + e2*t + e3 = EPS with e1, e2, e3 the elementary symmetric sums of the eigenvalues.
+def singular_fix(cov):
+	fix = np.zeros((len(cov), ))
+	for k in np.flatnonzero(np.linalg.det(cov) < EPS):
+		eig = np.linalg.eigvalsh(cov[k])
+		e1, e2, e3 = eig.sum(), eig[0]*eig[1] + eig[0]*eig[2] + eig[1]*eig[2], eig.prod()
+		roots = np.roots([1., e1, e2, e3 - EPS])
+		steps = max(1, int(np.ceil(roots[np.isreal(roots)].real.max() / SINGULAR_FIX - 1e-9)))
+		# Round-off of the root, at most a step
+		while np.linalg.det(cov[k] + steps * SINGULAR_FIX * np.eye(3)) < EPS:
+			steps += 1
+		fix[k] = steps * SINGULAR_FIX
+	return fix
+
+
+class ColorTable(object):
+	'''
+	The distinct colors of an image, or with bits < 8 the cells of a color grid with
+	2**bits levels per channel, plus the index of every pixel into them. GMM functions of a
+	color are then evaluated once per color through lookup, instead of once per pixel.
+	A cell stands for its center, so every channel is off by at most d = (2**(8-bits) - 1)/2
+	(d = 0 for bits=8, which is exact). Each component log-likelihood is then off by at most
+	sqrt(3)*d*|inv_cov @ (x - mean)| + 1.5*d**2*max_eig(inv_cov), and so is the model
+	log-likelihood (logsumexp never amplifies the largest error).
+	'''
+	def __init__(self, pixels, bits=8):
+		self.bits = bits
+		shift = 8 - bits
+		levels = np.asarray(pixels, np.uint8).reshape(-1, 3) >> shift
+		codes = (levels[:, 0].astype(np.int32) << 2*bits) | (levels[:, 1].astype(np.int32) << bits) | levels[:, 2]
+		# Dense table of all 2**(3*bits) codes, linear in the number of pixels unlike np.unique
+		present = np.zeros((1 << 3*bits, ), bool)
+		present[codes] = True
+		used = np.flatnonzero(present)
+		code_index = np.zeros((1 << 3*bits, ), np.int32)
+		code_index[used] = np.arange(len(used))
+		self.index = code_index[codes]
+		mask = (1 << bits) - 1
+		self.colors = np.stack([used >> 2*bits, (used >> bits) & mask, used & mask], axis=1).astype(np.float64)
+		self.colors = self.colors * (1 << shift) + ((1 << shift) - 1) / 2
+
+	# func of an (M, 3) color array, evaluated on the colors of the pixels selected by the
+	# boolean mask or indices select, and returned per selected pixel
+	def lookup(self, func, select):
+		index = self.index[select]
+		used = np.zeros((len(self.colors), ), bool)
+		used[index] = True
+		values = func(self.colors[used])
+		out = np.empty((len(self.colors), ), values.dtype)
+		out[used] = values
+		return out[index]
 
 
 class GaussianMixtureModel(object):
-	def __init__(self, K):
+	'''
+	init selects how init_components clusters the pixels: k-means++ in numpy ('kmeans++'),
+	OpenCV's cv.kmeans ('cv') or a full EM fit of sklearn's GaussianMixture ('sklearn').
+	The two k-means initializers only cluster at most max_samples random pixels, then assign
+	every pixel to its nearest center. seed makes them deterministic.
+	'''
+	def __init__(self, K, init='kmeans++', max_samples=20000, seed=0, instrumentation=None):
+		if init not in INIT_METHODS:
+			raise ValueError("Unknown GMM initializer: " + init)
+		self.instrumentation = instrumentation or NULL_INSTRUMENTATION
 		self.K = K
+		self.init = init
+		self.max_samples = max_samples
+		self.seed = seed
 		self.weight = np.empty((K,))
 		self.mean = np.empty((K, 3))
 		self.cov = np.empty((K, 3, 3))
 		self.det_cov = np.empty((K,)).astype(np.float64)
 		self.inv_cov = np.empty_like(self.cov)
+		# Cholesky factor of inv_cov, so that x.T @ inv_cov @ x == |x.T @ prec_chol|^2
+		self.prec_chol = np.empty_like(self.cov)
+		self.log_det_cov = np.empty((K,))
+
+	def update_component(self, k):
+		self.det_cov[k] = np.linalg.det(self.cov[k])
+		self.inv_cov[k] = np.linalg.inv(self.cov[k])
+		try:
+			self.prec_chol[k] = np.linalg.cholesky(self.inv_cov[k])
+		except np.linalg.LinAlgError:
+			# det passed EPS only through round-off, fix it like a singular covariance
+			self.cov[k] += np.diag([SINGULAR_FIX for i in range(3)])
+			return self.update_component(k)
+		self.log_det_cov[k] = np.log(self.det_cov[k])
+
+	def copy(self):
+		model = GaussianMixtureModel(self.K, self.init, self.max_samples, self.seed, self.instrumentation)
+		for name in ('weight', 'mean', 'cov', 'det_cov', 'inv_cov', 'prec_chol', 'log_det_cov'):
+			setattr(model, name, getattr(self, name).copy())
+		return model
+
+	def set_parameters(self, weight, mean, cov):
+		self.weight = np.array(weight, np.float64)
+		self.mean = np.array(mean, np.float64)
+		self.cov = np.array(cov, np.float64)
+		for k in range(self.K):
+			self.update_component(k)
+
+	# Compact binary form, 6 + 80*K bytes, see from_bytes and dump_models
+	def to_bytes(self):
+		cov = self.cov[:, TRIU[0], TRIU[1]]
+		return MODEL_HEADER.pack(MODEL_MAGIC, self.K) + np.concatenate(
+			(self.weight, self.mean.ravel(), cov.ravel())).astype('<f8').tobytes()
+
+	# Returns the model stored at offset of data, and the offset of what follows it
+	@classmethod
+	def from_bytes(cls, data, offset=0, **kw):
+		magic, K = MODEL_HEADER.unpack_from(data, offset)
+		if magic != MODEL_MAGIC:
+			raise ValueError("Not a serialized GaussianMixtureModel")
+		offset += MODEL_HEADER.size
+		values = np.frombuffer(data, '<f8', 10*K, offset)
+		cov = np.empty((K, 3, 3))
+		cov[:, TRIU[0], TRIU[1]] = values[4*K:].reshape(K, 6)
+		cov[:, TRIU[1], TRIU[0]] = cov[:, TRIU[0], TRIU[1]]
+		model = cls(K, **kw)
+		model.set_parameters(values[:K], values[K:4*K].reshape(K, 3), cov)
+		return model, offset + 80*K
+
+	# Model of an OpenCV 1x65 model array, as filled by cv.grabCut
+	@classmethod
+	def from_cv(cls, model, **kw):
+		model = np.asarray(model, np.float64).ravel()
+		K = CV_COMPONENTS
+		gmm = cls(K, **kw)
+		gmm.set_parameters(model[:K], model[K:4*K].reshape(K, 3), model[4*K:].reshape(K, 3, 3))
+		return gmm
+
+	def to_cv(self):
+		if self.K != CV_COMPONENTS:
+			raise ValueError("OpenCV models have %d components, not %d" % (CV_COMPONENTS, self.K))
+		return np.concatenate((self.weight, self.mean.ravel(), self.cov.ravel()))[np.newaxis, :]
+
+	# update_component of several components at once
+	def update_components(self, ks):
+		cov = self.cov[ks]
+		self.det_cov[ks] = np.linalg.det(cov)
+		self.inv_cov[ks] = np.linalg.inv(cov)
+		try:
+			self.prec_chol[ks] = np.linalg.cholesky(self.inv_cov[ks])
+		except np.linalg.LinAlgError:
+			for k in ks:
+				self.update_component(k)
+			return
+		self.log_det_cov[ks] = np.log(self.det_cov[ks])
 
 	# Use k-means to cluster components
+	@timeit
 	def init_components(self, pixels):
-		gmm = GaussianMixture(self.K)
+		if self.init == 'sklearn':
+			return self.init_components_sklearn(pixels)
+		rng = np.random.default_rng(self.seed)
+		samples = pixels
+		if len(pixels) > self.max_samples:
+			samples = pixels[rng.integers(len(pixels), size=self.max_samples)]
+		samples = np.asarray(samples, np.float64)
+		if self.init == 'cv':
+			centers = cv_kmeans(samples, self.K, self.seed)
+		else:
+			centers = kmeans_pp(samples, self.K, rng)
+		components = nearest_centers(pixels, centers)
+		self.learn(pixels, components)
+		# Components left empty (fewer distinct colors than K) copy the largest one, with no weight
+		largest = np.argmax(self.weight)
+		for k in np.flatnonzero(self.weight == 0):
+			self.mean[k], self.cov[k] = self.mean[largest], self.cov[largest]
+			self.update_component(k)
+		return components
+
+	def init_components_sklearn(self, pixels):
+		# Only needed by this initializer, and slow to import
+		from sklearn.mixture import GaussianMixture
+		gmm = GaussianMixture(self.K, random_state=self.seed)
 		components = gmm.fit_predict(pixels)
 		self.weight = gmm.weights_
 		self.mean = gmm.means_
 		self.cov = gmm.covariances_
 		for k in range(self.K):
-			self.det_cov[k] = np.linalg.det(self.cov[k])
-			self.inv_cov[k] = np.linalg.inv(self.cov[k])
+			self.update_component(k)
 		return components
 
 	# Define how a pixel fit into a component k of this model
@@ -40,22 +261,142 @@ class GaussianMixtureModel(object):
 	def get_component(self, pixel):
 		return np.argmax([self.component_likelihood(pixel, k) for k in range(self.K)])
 
+	# Log of component_likelihood for every pixel and every component, shape (N, K)
+	def component_log_likelihoods(self, pixels):
+		pixels = np.asarray(pixels, dtype=np.float64).reshape(-1, 3)
+		log_lik = np.empty((len(pixels), self.K))
+		for k in range(self.K):
+			x = (pixels - self.mean[k]) @ self.prec_chol[k]
+			log_lik[:, k] = -0.5 * (self.log_det_cov[k] + np.einsum('ij,ij->i', x, x))
+		return log_lik
+
+	# Log of model_likelihood for every pixel, shape (N, ), a weighted logsumexp over the
+	# components without scipy's per-call overhead
+	def model_log_likelihood(self, pixels):
+		# A model learned from no pixels explains none, like scipy's logsumexp of -inf
+		if not self.weight.any():
+			return np.full((len(pixels), ), -np.inf)
+		out = np.empty((len(pixels), ))
+		with np.errstate(divide='ignore'):
+			log_weight = np.log(self.weight)
+		for i in range(0, len(pixels), CHUNK_SIZE):
+			log_lik = self.component_log_likelihoods(pixels[i:i+CHUNK_SIZE])
+			log_lik += log_weight
+			top = log_lik.max(axis=1)
+			log_lik -= top[:, np.newaxis]
+			np.exp(log_lik, out=log_lik)
+			out[i:i+CHUNK_SIZE] = top + np.log(log_lik.sum(axis=1))
+		return out
+
 	def get_components(self, pixels):
-		return np.array([self.get_component(pixel) for pixel in pixels])
+		out = np.empty((len(pixels), ), np.uint8)
+		for i in range(0, len(pixels), CHUNK_SIZE):
+			out[i:i+CHUNK_SIZE] = np.argmax(self.component_log_likelihoods(pixels[i:i+CHUNK_SIZE]), axis=1)
+		return out
 
-	def learn(self, pixels, components):
-		for k in range(self.K):
-			sub_pixels = pixels[components == k]
-			# print(k, len(sub_pixels))
-			if len(sub_pixels) == 0:
-				self.weight[k] = 0.
-				continue
-			self.mean[k] = np.mean(sub_pixels, axis=0)
-			#print(sub_pixels, self.mean[k])
-			self.cov[k] = np.cov(sub_pixels.T)
-			self.det_cov[k] = np.linalg.det(self.cov[k])
-			while self.det_cov[k] < EPS:
-				self.cov[k] += np.diag([SINGULAR_FIX for i in range(3)])
-				self.det_cov[k] = np.linalg.det(self.cov[k])
-			self.inv_cov[k] = np.linalg.inv(self.cov[k])
-			self.weight[k] = len(sub_pixels) / len(pixels)
+	# Refits every component in one pass over the pixels, accumulating per-component counts,
+	# sums and sums of outer products chunk by chunk. With a boolean select only the selected
+	# pixels (and their components) are used, so callers need not copy them out first.
+	# prior, statistics of other pixels (see statistics), is added to theirs.
+	@timeit
+	def learn(self, pixels, components, select=None, prior=None):
+		counts, sums, products = self.statistics(pixels, components, select)
+		if prior is not None:
+			counts, sums, products = counts + prior[0], sums + prior[1], products + prior[2]
+		self.learn_statistics(counts, sums, products)
+
+	# Per-component pixel counts, color sums and upper triangles of the sums of outer products
+	# of the (selected) pixels, colors centered on COLOR_CENTER, shapes (K, ), (K, 3), (K, 6)
+	def statistics(self, pixels, components, select=None):
+		counts = np.zeros((self.K, ))
+		sums = np.zeros((self.K, 3))
+		products = np.zeros((self.K, 6))
+		for i in range(0, len(pixels), CHUNK_SIZE):
+			x, labels = pixels[i:i+CHUNK_SIZE], components[i:i+CHUNK_SIZE]
+			if select is not None:
+				x, labels = x[select[i:i+CHUNK_SIZE]], labels[select[i:i+CHUNK_SIZE]]
+			# Centered on the middle of the color range, better conditioned sums of squares
+			x = np.asarray(x, np.float64) - COLOR_CENTER
+			counts += np.bincount(labels, minlength=self.K)
+			for c in range(3):
+				sums[:, c] += np.bincount(labels, x[:, c], minlength=self.K)
+			for j, (a, b) in enumerate(zip(*TRIU)):
+				products[:, j] += np.bincount(labels, x[:, a] * x[:, b], minlength=self.K)
+		return counts, sums, products
+
+	# Refits the components from their pixel counts, sums and upper triangles of the sums of
+	# outer products, colors centered on COLOR_CENTER
+	def learn_statistics(self, counts, sums, products):
+		# Empty components keep their parameters, with no weight
+		self.weight = counts / max(counts.sum(), 1)
+		learned = np.flatnonzero(counts)
+		n = counts[learned]
+		mean = sums[learned] / n[:, np.newaxis]
+		outer = np.empty((len(learned), 3, 3))
+		outer[:, TRIU[0], TRIU[1]] = products[learned]
+		outer[:, TRIU[1], TRIU[0]] = products[learned]
+		# Unbiased like np.cov, a single pixel starts from a singular covariance instead of nan
+		cov = (outer - n[:, np.newaxis, np.newaxis] * mean[:, :, np.newaxis] * mean[:, np.newaxis, :])
+		cov /= np.maximum(n - 1, 1)[:, np.newaxis, np.newaxis]
+		cov[n == 1] = 0.
+		cov += singular_fix(cov)[:, np.newaxis, np.newaxis] * np.eye(3)
+		self.mean[learned] = mean + COLOR_CENTER
+		self.cov[learned] = cov
+		self.update_components(learned)
+
+
+def dump_models(models):
+	return b''.join(model.to_bytes() for model in models)
+
+
+# Models of dump_models, e.g. (bgdModel, fgdModel); kw are passed to GaussianMixtureModel
+def load_models_bytes(data, **kw):
+	models, offset = [], 0
+	while offset < len(data):
+		model, offset = GaussianMixtureModel.from_bytes(data, offset, **kw)
+		models.append(model)
+	return tuple(models)
+
+
+def save_models(path, models):
+	with open(path, 'wb') as f:
+		f.write(dump_models(models))
+
+
+def load_models(path, **kw):
+	with open(path, 'rb') as f:
+		return load_models_bytes(f.read(), **kw)
+
+
+class ModelCache(object):
+	'''
+	LRU cache of fitted (bgdModel, fgdModel) keyed by the content of the image, so that
+	segmenting the same image again starts from its last models instead of clustering.
+	Entries are kept serialized, a few hundred bytes each.
+	'''
+	def __init__(self, capacity=128):
+		self.capacity = capacity
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	@staticmethod
+	def key(img):
+		digest = hashlib.blake2b(str(img.shape).encode(), digest_size=16)
+		digest.update(np.ascontiguousarray(img).data)
+		return digest.hexdigest()
+
+	def get(self, key, **kw):
+		data = self.entries.get(key)
+		if data is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		self.entries.move_to_end(key)
+		return load_models_bytes(data, **kw)
+
+	def put(self, key, models):
+		self.entries[key] = dump_models(models)
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.capacity:
+			self.entries.popitem(last=False)
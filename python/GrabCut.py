@@ -1,10 +1,14 @@
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 import cv2 as cv
 import numpy as np
 from enum import IntEnum
-from GMM import GaussianMixtureModel
-from GCGraph import GCGraph
+from GMM import GaussianMixtureModel, ColorTable
+from GCGraph import GCGraph, TiledGCGraph, BandGCGraph, RegionGCGraph
+from Superpixels import superpixels
+from BorderMatting import border_matting
+from Instrumentation import NULL_INSTRUMENTATION, timeit
 
 class Color:
     Black = [0, 0, 0]
@@ -24,14 +28,42 @@ class Matte(IntEnum):
     FGD = 1
 
 
-def timeit(func):
-    def wrapper(*args, **kw):
-        time1 = time.time()
-        result = func(*args, **kw)
-        time2 = time.time()
-        print(func.__name__, time2-time1)
-        return result
-    return wrapper
+# Decodes an image given as a path (.npy files are memory-mapped), encoded bytes (JPEG, PNG...)
+# or an array. BGR uint8 arrays are used as they are, without a copy, grayscale and BGRA ones are
+# converted to BGR.
+def read_image(source):
+    if isinstance(source, np.ndarray):
+        img = source
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        img = cv.imdecode(np.frombuffer(source, np.uint8), cv.IMREAD_COLOR)
+        if img is None:
+            raise ValueError("Cannot decode the image bytes")
+    elif source.endswith('.npy'):
+        img = np.load(source, mmap_mode='r')
+    else:
+        img = cv.imread(source)
+        if img is None:
+            raise IOError("Cannot read " + source)
+    if img.dtype != np.uint8:
+        raise ValueError("Expected a uint8 image, got " + str(img.dtype))
+    if img.ndim == 2:
+        img = cv.cvtColor(img, cv.COLOR_GRAY2BGR)
+    elif img.shape[2] == 4:
+        img = cv.cvtColor(img, cv.COLOR_BGRA2BGR)
+    elif img.shape[2] != 3:
+        raise ValueError("Expected a BGR image, got shape " + str(img.shape))
+    return np.ascontiguousarray(img)
+
+
+# Sink for GrabCut.run writing the cutout to resultPath: with the matte as alpha channel,
+# or on a black background for formats without one (e.g. JPEG)
+def file_sink(resultPath):
+    def write(matte, cutout):
+        if os.path.splitext(resultPath)[1].lower() in ('.png', '.tif', '.tiff', '.webp'):
+            cv.imwrite(resultPath, cutout)
+        else:
+            cv.imwrite(resultPath, cutout[:, :, :3])
+    return write
 
 
 class GrabCut(object):
@@ -44,10 +76,19 @@ class GrabCut(object):
     The unknown pixels is the foreground set.
     - Create foreground and background GMMs based off the sets previously defined.
     '''
-    @timeit
-    def __init__(self, imagePath, n_components=5, iterCount=1, useCV=True):
-        self.imagePath = imagePath
-        self.img = cv.imread(imagePath)
+    def __init__(self, imagePath, n_components=5, iterCount=1, useCV=True, reuseGraph=False, minChanged=0,
+                 pyramid=(), bandWidth=None, gamma=50, tileSize=None, tileOverlap=32,
+                 initMethod='kmeans++', initSamples=20000, seed=0, quantize=None, instrumentation=None,
+                 models=None, modelCache=None, backend=None, neighborhood=8, borderMatting=None,
+                 superpixels=None, superpixelMethod='grid', superpixelBand=None, graph=None):
+        # Constructor options (before any other local), the GrabCuts of crop and coarse_to_fine
+        # are built from them, see child_options
+        self.options = {name: value for name, value in locals().items() if name not in ('self', 'imagePath', 'graph')}
+        # Phase times, counters and per-iteration series of each segment run, off by default
+        self.instrumentation = instrumentation or NULL_INSTRUMENTATION
+        # imagePath may also be encoded bytes or a decoded BGR image, see read_image
+        self.imagePath = imagePath if isinstance(imagePath, str) else None
+        self.img = read_image(imagePath)
         self.imgShape = self.img.shape[:2]
         self.h, self.w = self.imgShape
         self.N = self.imgShape[0] * self.imgShape[1]
@@ -55,12 +96,28 @@ class GrabCut(object):
         self.n_components = n_components
         self.iterCount = iterCount
         self.useCV = useCV
+        # Keep the graph between iterations and only update the changed T-links
+        self.reuseGraph = reuseGraph
+        # Stop iterating once fewer than minChanged pixels change their label
+        self.minChanged = minChanged
+        # Time and number of changed labels of each iteration
+        self.iterStats = []
+        # Downscale factors of the coarser levels, e.g. (0.5, 0.25) segments at 1/4 scale first,
+        # then only re-solves a band of bandWidth pixels around the boundary at 1/2 and full scale.
+        # Coarse levels scale gamma with the image so the smoothness term (~ boundary length)
+        # keeps its balance against the data term (~ area); OpenCV's gamma is fixed at 50.
+        self.pyramid = tuple(pyramid)
+        self.bandWidth = bandWidth
         # User-input trimap
         self.mask = np.zeros(self.imgShape, np.uint8)
         self.bgdModel = None
         self.fgdModel = None
         # Matte segmentation value,
         self.alpha = None
+        # Width in pixels of the band around the boundary given a soft alpha after segmenting,
+        # None for the hard matte only, and that soft alpha, see border_matting
+        self.borderMatting = borderMatting
+        self.softAlpha = None
         # GMM components index
         self.components = np.empty((self.N, ), np.uint8)
         self.trimap_bgd = None
@@ -68,24 +125,93 @@ class GrabCut(object):
         self.trimap_ukn = None
         self.matte_bgd = None
         self.matte_fgd = None
-        #self.graph = GCGraph(self.img)
+        self.gamma = gamma
+        # GMM initializer, see GaussianMixtureModel, and the time it took in init_with_mask
+        self.initMethod = initMethod
+        self.initSamples = initSamples
+        self.seed = seed
+        self.initTime = None
+        # Fitted (bgdModel, fgdModel) GaussianMixtureModels to start from instead of clustering the
+        # pixels, e.g. from load_models or the previous frame, and a ModelCache looked up by segment
+        self.initModels = models
+        self.modelCache = modelCache
+        # Min-cut solver of the Python engine: 'pymaxflow' (default if installed), 'scipy' or 'opencv',
+        # see CutBackends. Only 'pymaxflow' can reuse its graph between iterations (reuseGraph).
+        self.backend = backend
+        # Connectivity of the N-links of the Python engine: 4, 8 (GrabCut's and OpenCV's) or 16,
+        # whose weights follow the angles and lengths of the neighbor offsets, see neighbor_weights
+        self.neighborhood = neighborhood
+        # Side in pixels of the regions the Python engine segments instead of pixels, None for pixels,
+        # oversegmented by superpixelMethod ('grid' or 'slic'), see segment_regions. The final cut runs on
+        # all the pixels with the learned GMMs, or with superpixelBand only on a band of that many pixels
+        # around the region matte's boundary (0 keeps the region matte).
+        self.superpixels = superpixels
+        self.superpixelMethod = superpixelMethod
+        self.superpixelBand = superpixelBand
+        # Solve the cut tile by tile to bound the memory of the graph, see TiledGCGraph
+        self.tileSize = tileSize
+        self.tileOverlap = tileOverlap
+        # Bits per channel of the ColorTable the GMMs are evaluated through, 8 for exact
+        # per distinct color, None to evaluate every pixel
+        self.quantize = quantize
+        self.table = ColorTable(self.pixels, quantize) if quantize and not useCV else None
+        # Objects of the last segment_objects, (region, GrabCut of the region)
+        self.objects = []
+        # (model, statistics) of background pixels outside this image, e.g. around a crop of
+        # segment_objects: bgdModel starts from model and always learns their statistics too
+        self.bgdPrior = None
+        if useCV or superpixels:
+            # Region graphs are built by segment_regions
+            self.graph = None
+        elif graph is not None:
+            # Prebuilt for this image, e.g. a crop sharing the N-links of a larger one (GCGraph.crop),
+            # its T-links go through this image's ColorTable
+            self.graph = graph
+            self.graph.table = self.table
+        elif tileSize:
+            self.graph = TiledGCGraph(self.img, gamma, tileSize, tileOverlap, self.instrumentation, backend,
+                                      neighborhood)
+        else:
+            self.graph = GCGraph(self.img, gamma, table=self.table, instrumentation=self.instrumentation,
+                                 backend=backend, neighborhood=neighborhood)
 
-    @timeit
     def init_with_rect(self, rect):
-        self.mask[:, :] = Trimap.BGD
+        trimap = np.full(self.imgShape, Trimap.BGD, np.uint8)
         x1, y1, x2, y2 = rect
-        self.mask[y1:y2, x1:x2] = Trimap.UKN
-        self.mask = self.mask.reshape((self.N, ))
-        self.alpha = np.where(self.mask == Trimap.BGD, Matte.BGD, Matte.FGD)
-        self.trimap_bgd = np.where(self.mask == Trimap.BGD)
-        self.trimap_fgd = np.where(self.mask == Trimap.FGD)
-        self.trimap_ukn = np.where(self.mask == Trimap.UKN)
-        self.matte_bgd = np.where(self.alpha == Matte.BGD)
-        self.matte_fgd = np.where(self.alpha == Matte.FGD)
-        self.bgdModel = GaussianMixtureModel(self.n_components)
-        self.fgdModel = GaussianMixtureModel(self.n_components)
-        self.components[self.matte_bgd] = self.bgdModel.init_components(self.pixels[self.matte_bgd])
-        self.components[self.matte_fgd] = self.fgdModel.init_components(self.pixels[self.matte_fgd])
+        trimap[y1:y2, x1:x2] = Trimap.UKN
+        self.init_with_mask(trimap)
+
+    # Same as init_with_rect for an arbitrary trimap, UKN pixels start as foreground
+    @timeit
+    def init_with_mask(self, trimap):
+        self.mask = np.array(trimap, np.uint8).reshape((self.N, ))
+        self.alpha = np.where(self.mask == Trimap.BGD, Matte.BGD, Matte.FGD).astype(np.uint8)
+        self.trimap_bgd = self.mask == Trimap.BGD
+        self.trimap_fgd = self.mask == Trimap.FGD
+        self.trimap_ukn = self.mask == Trimap.UKN
+        self.matte_bgd = self.alpha == Matte.BGD
+        self.matte_fgd = self.alpha == Matte.FGD
+        start = time.time()
+        if self.initModels is not None:
+            # Warm start, the supplied models are copied since learning updates them in place
+            self.bgdModel, self.fgdModel = (model.copy() for model in self.initModels)
+            self.bgdModel.instrumentation = self.fgdModel.instrumentation = self.instrumentation
+            self.components[self.matte_bgd] = self.bgdModel.get_components(self.pixels[self.matte_bgd])
+            self.components[self.matte_fgd] = self.fgdModel.get_components(self.pixels[self.matte_fgd])
+        else:
+            if self.bgdPrior is not None:
+                self.bgdModel = self.bgdPrior[0].copy()
+                self.bgdModel.instrumentation = self.instrumentation
+                self.components[self.matte_bgd] = self.bgdModel.get_components(self.pixels[self.matte_bgd])
+            else:
+                self.bgdModel = GaussianMixtureModel(self.n_components, self.initMethod, self.initSamples,
+                                                     self.seed, self.instrumentation)
+                self.components[self.matte_bgd] = self.bgdModel.init_components(self.pixels[self.matte_bgd])
+            self.fgdModel = GaussianMixtureModel(self.n_components, self.initMethod, self.initSamples, self.seed,
+                                                 self.instrumentation)
+            self.components[self.matte_fgd] = self.fgdModel.init_components(self.pixels[self.matte_fgd])
+        self.initTime = time.time() - start
+        self.instrumentation.count('ukn_pixels', int(np.count_nonzero(self.trimap_ukn)))
 
     '''
     Assign a foreground and background GMM cluster to every pixel in the unknown set 
@@ -93,8 +219,12 @@ class GrabCut(object):
     '''
     @timeit
     def assign_GMM(self):
-        matte_bgd = np.where(np.logical_and(self.alpha == Matte.BGD, self.mask == Trimap.UKN))
-        matte_fgd = np.where(np.logical_and(self.alpha == Matte.FGD, self.mask == Trimap.UKN))
+        matte_bgd = np.logical_and(self.alpha == Matte.BGD, self.mask == Trimap.UKN)
+        matte_fgd = np.logical_and(self.alpha == Matte.FGD, self.mask == Trimap.UKN)
+        if self.table is not None:
+            self.components[matte_bgd] = self.table.lookup(self.bgdModel.get_components, matte_bgd)
+            self.components[matte_fgd] = self.table.lookup(self.fgdModel.get_components, matte_fgd)
+            return
         self.components[matte_bgd] = self.bgdModel.get_components(self.pixels[matte_bgd])
         self.components[matte_fgd] = self.fgdModel.get_components(self.pixels[matte_fgd])
 
@@ -105,53 +235,355 @@ class GrabCut(object):
     '''
     @timeit
     def learn_GMM(self):
-        self.bgdModel.learn(self.pixels[self.matte_bgd], self.components[self.matte_bgd])
-        self.fgdModel.learn(self.pixels[self.matte_fgd], self.components[self.matte_fgd])
+        self.bgdModel.learn(self.pixels, self.components, self.matte_bgd,
+                            None if self.bgdPrior is None else self.bgdPrior[1])
+        self.fgdModel.learn(self.pixels, self.components, self.matte_fgd)
 
     @timeit
     def graph_cut(self):
-        self.graph.build_graph(self.mask, self.bgdModel, self.fgdModel)
-        self.alpha = self.graph.cut()
-        self.matte_bgd = np.where(self.alpha == Matte.BGD)
-        self.matte_fgd = np.where(self.alpha == Matte.FGD)
-        print("bgd:", len(self.matte_bgd[0]), "fgd:", len(self.matte_fgd[0]))
-
-    def write_result(self, img):
-        dirname, filename = os.path.split(self.imagePath)
-        filename, fileext = os.path.splitext(filename)
-        resultPath = os.path.join(dirname, filename) + "_result" + fileext
+        if self.reuseGraph and self.graph.graph is not None:
+            self.graph.update_graph(self.mask, self.bgdModel, self.fgdModel)
+            alpha = self.graph.cut(reuse_trees=True)
+        else:
+            self.graph.build_graph(self.mask, self.bgdModel, self.fgdModel)
+            alpha = self.graph.cut()
+        return self.update_alpha(alpha)
+
+    # Replace alpha by a new cut, returns how many pixels changed label
+    def update_alpha(self, alpha):
+        changed = int(np.count_nonzero(alpha != self.alpha))
+        self.alpha = alpha
+        self.matte_bgd = self.alpha == Matte.BGD
+        self.matte_fgd = self.alpha == Matte.FGD
+        self.instrumentation.append('fgd_pixels', int(np.count_nonzero(self.matte_fgd)))
+        self.instrumentation.append('changed', changed)
+        return changed
+
+    @timeit
+    def iterate(self):
+        start = time.time()
+        self.assign_GMM()
+        self.learn_GMM()
+        changed = self.graph_cut()
+        self.iterStats.append({'time': time.time() - start, 'changed': changed})
+        return changed
+
+    # Writes img to resultPath, by default <image>_result.<ext> next to the input image
+    def write_result(self, img, resultPath=None):
+        if resultPath is None:
+            if self.imagePath is None:
+                raise ValueError("The image was not read from a file, give a resultPath")
+            dirname, filename = os.path.split(self.imagePath)
+            filename, fileext = os.path.splitext(filename)
+            resultPath = os.path.join(dirname, filename) + "_result" + fileext
         cv.imwrite(resultPath, img)
         return resultPath
 
-    def run(self, rect, init_mask):
-        result = None
+    # Region of a rect, given as (x1, y1, x2, y2) for this engine and (x, y, w, h) for OpenCV
+    def rect_region(self, rect):
+        x1, y1, x2, y2 = rect
+        if self.useCV:
+            x2, y2 = x1 + x2, y1 + y2
+        return slice(y1, y2), slice(x1, x2)
+
+    # Fitted (bgdModel, fgdModel) as GaussianMixtureModels for either engine, None before segmenting
+    def get_models(self):
+        if self.bgdModel is None:
+            return None
         if self.useCV:
-            mode = 0
-            if init_mask is not None:
-                mode = cv.GC_INIT_WITH_MASK
-                self.mask[init_mask == Trimap.BGD] = cv.GC_BGD
-                self.mask[init_mask == Trimap.FGD] = cv.GC_FGD
-            if rect is not None:
-                mode = cv.GC_INIT_WITH_RECT
-                self.bgdModel = np.zeros((1, 65), np.float64)
-                self.fgdModel = np.zeros((1, 65), np.float64)
-            cv.grabCut(self.img, self.mask, rect, self.bgdModel, self.fgdModel, self.iterCount, mode)
-            mask2 = np.where((self.mask == 2) | (self.mask == 0), 0, 1).astype('uint8')
-            result = self.img*mask2[:, :, np.newaxis]
+            return (GaussianMixtureModel.from_cv(self.bgdModel, instrumentation=self.instrumentation),
+                    GaussianMixtureModel.from_cv(self.fgdModel, instrumentation=self.instrumentation))
+        return self.bgdModel, self.fgdModel
+
+    # Hard segmentation of the image, shape (h, w)
+    def get_matte(self):
+        if self.useCV:
+            return np.where((self.mask == 2) | (self.mask == 0), 0, 1).astype('uint8')
+        return self.alpha.reshape(self.imgShape).astype('uint8')
+
+    # Alpha matte of the image, shape (h, w), float32 in [0, 1] or uint8 in [0, 255]: the soft alpha
+    # with borderMatting, otherwise the hard matte
+    def get_alpha(self, dtype=np.float32):
+        alpha = self.softAlpha if self.softAlpha is not None else self.get_matte().astype(np.float32)
+        if np.dtype(dtype) == np.uint8:
+            return np.round(alpha * 255).astype(np.uint8)
+        return alpha.astype(dtype, copy=False)
+
+    @timeit
+    def border_matting(self, matte):
+        self.softAlpha = border_matting(self.img, matte, self.borderMatting)
+        self.instrumentation.count('soft_pixels', int(np.count_nonzero((self.softAlpha > 0) & (self.softAlpha < 1))))
+
+    # BGRA cutout of the foreground, shape (h, w, 4), the matte (0/1) or a float alpha in [0, 1]
+    # scaled to the alpha channel
+    def get_cutout(self, matte=None):
+        if matte is None:
+            matte = self.get_matte()
+        cutout = np.empty(self.imgShape + (4, ), np.uint8)
+        if matte.dtype.kind == 'f':
+            cutout[:, :, :3] = np.round(self.img * matte[:, :, np.newaxis])
+            cutout[:, :, 3] = np.round(matte * 255)
+            return cutout
+        np.multiply(self.img, matte[:, :, np.newaxis], out=cutout[:, :, :3])
+        np.multiply(matte, 255, out=cutout[:, :, 3])
+        return cutout
+
+    @timeit
+    def coarse_to_fine(self, rect):
+        scale = self.pyramid[0]
+        coarse = GrabCut(cv.resize(self.img, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA),
+                         **self.child_options(pyramid=[s / scale for s in self.pyramid[1:]], gamma=self.gamma * scale,
+                                              borderMatting=None))
+        if self.bgdPrior is not None:
+            # The statistics are sums over pixels, so they shrink with the area
+            model, statistics = self.bgdPrior
+            coarse.bgdPrior = model, tuple(s * scale**2 for s in statistics)
+        coarse.segment(tuple(int(round(v * scale)) for v in rect), None)
+        matte = cv.resize(coarse.get_matte() * 255, (self.w, self.h), interpolation=cv.INTER_LINEAR) > 127
+        # Everything but a band around the upsampled boundary is fixed,
+        # the GMMs are colour statistics so the coarse ones are reused as they are
+        bandWidth = self.bandWidth or int(np.ceil(2 / scale))
+        kernel = cv.getStructuringElement(cv.MORPH_ELLIPSE, (2*bandWidth + 1, 2*bandWidth + 1))
+        band = cv.dilate(matte.astype(np.uint8), kernel) != cv.erode(matte.astype(np.uint8), kernel)
+        inside = np.zeros(self.imgShape, bool)
+        inside[self.rect_region(rect)] = True
+        band &= inside
+        matte &= inside
+        self.bgdModel, self.fgdModel = coarse.bgdModel, coarse.fgdModel
+        if self.useCV:
+            self.mask = np.where(matte, cv.GC_FGD, cv.GC_BGD).astype(np.uint8)
+            self.mask[band] = np.where(matte[band], cv.GC_PR_FGD, cv.GC_PR_BGD)
+            cv.grabCut(self.img, self.mask, None, self.bgdModel, self.fgdModel, 1, cv.GC_EVAL_FREEZE_MODEL)
         else:
-            if rect is not None:
-                print(rect)
-                self.init_with_rect(rect)
+            self.mask = np.where(matte, Trimap.FGD, Trimap.BGD).astype(np.uint8)
+            self.mask[band] = Trimap.UKN
+            self.mask = self.mask.reshape((self.N, ))
+            self.alpha = matte.reshape((self.N, )).astype(np.uint8)
+            self.graph_cut()
+
+    '''
+    GrabCut on superpixels: the iterations cut the region adjacency graph of the oversegmentation
+    (RegionGCGraph) instead of the pixel graph, assign_GMM and learn_GMM still run on the pixels.
+    The GMMs they learn then drive one cut of the whole pixel graph, or with superpixelBand of a
+    band around the region matte's boundary (BandGCGraph). A cut restricted to the regions can
+    lose a thin or low-contrast object, so the pixel cut also runs with the models of the last
+    iteration that still had a foreground. When the region matte lost all or most of its UKN
+    foreground the whole pixel graph is cut even with superpixelBand.
+    '''
+    @timeit
+    def segment_regions(self, trimap):
+        with self.instrumentation.phase('superpixels'):
+            labels, count = superpixels(self.img, trimap, self.superpixels, self.superpixelMethod)
+        graph = RegionGCGraph(self.img, labels, count, self.gamma, instrumentation=self.instrumentation,
+                              neighborhood=self.neighborhood)
+        mask = np.empty((count, ), np.uint8)
+        mask[labels] = trimap
+        # Models are assigned and learned on the pixels like iterate, only the cut runs on the regions
+        self.init_with_mask(trimap)
+        # Largest foreground of the UKN pixels over the region cuts
+        largest = 0
+        for _ in range(self.iterCount):
+            if not self.matte_fgd.any():
+                # Nothing left to learn a foreground model from
+                break
+            start = time.time()
+            self.assign_GMM()
+            self.learn_GMM()
+            with self.instrumentation.phase('graph_cut'):
+                graph.build_graph(mask, self.bgdModel, self.fgdModel)
+                changed = self.update_alpha(graph.cut()[labels].reshape((self.N, )))
+            largest = max(largest, int(np.count_nonzero(self.matte_fgd & self.trimap_ukn)))
+            self.iterStats.append({'time': time.time() - start, 'changed': changed})
+            if changed < self.minChanged:
+                break
+        # A band around a lost (or mostly lost) object cannot bring it back
+        kept = np.count_nonzero(self.matte_fgd & self.trimap_ukn)
+        lost = kept == 0 or kept < largest / 4
+        self.instrumentation.count('superpixel_fallback', bool(lost and self.superpixelBand is not None))
+        if self.superpixelBand is None or lost:
+            # The region cut only stands in for the pixel one while the models are learned, a cut
+            # restricted to the regions can lose a thin or low-contrast object altogether
+            pixelGraph = GCGraph(self.img, self.gamma, graph.beta, table=self.table,
+                                 instrumentation=self.instrumentation, backend=self.backend,
+                                 neighborhood=self.neighborhood)
+            pixelGraph.build_graph(self.mask, self.bgdModel, self.fgdModel)
+            matte = pixelGraph.cut()
+        elif self.superpixelBand:
+            matte = self.alpha.reshape(self.imgShape)
+            kernel = cv.getStructuringElement(cv.MORPH_ELLIPSE, (2*self.superpixelBand + 1, 2*self.superpixelBand + 1))
+            band = (cv.dilate(matte, kernel) != cv.erode(matte, kernel)).reshape(self.N) & (self.mask == Trimap.UKN)
+            refine = np.where(self.mask == Trimap.UKN, matte.reshape(self.N), self.mask).astype(np.uint8)
+            refine[band] = Trimap.UKN
+            bandGraph = BandGCGraph(self.img, self.gamma, graph.beta, self.instrumentation, self.neighborhood)
+            bandGraph.build_graph(refine, self.bgdModel, self.fgdModel)
+            matte = bandGraph.cut()
+        else:
+            matte = self.alpha
+        self.update_alpha(matte.reshape((self.N, )))
+
+    def segment(self, rect, init_mask):
+        self.instrumentation.start_run(engine='cv' if self.useCV else 'python', height=self.h, width=self.w)
+        self.softAlpha = None
+        try:
+            cacheKey = None
+            if self.modelCache is not None:
+                cacheKey = self.modelCache.key(self.img)
+                cached = self.modelCache.get(cacheKey, instrumentation=self.instrumentation)
+                self.instrumentation.count('model_cache_hit', cached is not None)
+                if cached is not None:
+                    self.initModels = cached
+            if self.superpixels and not self.useCV and (rect is not None or init_mask is not None):
+                if rect is not None:
+                    init_mask = np.full(self.imgShape, Trimap.BGD, np.uint8)
+                    init_mask[self.rect_region(rect)] = Trimap.UKN
+                self.segment_regions(init_mask)
+            elif self.pyramid and rect is not None:
+                self.coarse_to_fine(rect)
+            elif self.useCV:
+                # GC_INIT_WITH_RECT is 0, like "no init", so whether this run initializes is kept apart
+                mode, init = cv.GC_EVAL, False
+                if init_mask is not None:
+                    mode, init = cv.GC_INIT_WITH_MASK, True
+                    if self.bgdModel is None:
+                        # Nothing segmented yet, the unmarked pixels are unknown
+                        self.mask[:, :] = cv.GC_PR_FGD
+                    self.mask[init_mask == Trimap.BGD] = cv.GC_BGD
+                    self.mask[init_mask == Trimap.FGD] = cv.GC_FGD
+                if rect is not None:
+                    mode, init = cv.GC_INIT_WITH_RECT, True
+                    self.bgdModel = np.zeros((1, 65), np.float64)
+                    self.fgdModel = np.zeros((1, 65), np.float64)
+                if self.initModels is not None and init:
+                    # Warm start: OpenCV only skips its k-means when given a mask to evaluate
+                    if rect is not None:
+                        self.mask[:, :] = cv.GC_BGD
+                        self.mask[self.rect_region(rect)] = cv.GC_PR_FGD
+                    self.bgdModel, self.fgdModel = (model.to_cv() for model in self.initModels)
+                    mode = cv.GC_EVAL
+                with self.instrumentation.phase('cv.grabCut'):
+                    cv.grabCut(self.img, self.mask, rect, self.bgdModel, self.fgdModel, self.iterCount, mode)
+            elif rect is not None or init_mask is not None:
+                if rect is not None:
+                    self.init_with_rect(rect)
+                else:
+                    self.init_with_mask(init_mask)
                 for _ in range(self.iterCount):
-                    self.assign_GMM()
-                    self.learn_GMM()
-                    self.graph_cut()
-                result = self.img * self.alpha.reshape(self.imgShape)[:, :, np.newaxis]
-        return self.write_result(result)
+                    if self.iterate() < self.minChanged:
+                        break
+            if cacheKey is not None and self.bgdModel is not None:
+                self.modelCache.put(cacheKey, self.get_models())
+            matte = self.get_matte()
+            if self.borderMatting:
+                self.border_matting(matte)
+        finally:
+            self.instrumentation.finish_run()
+        return matte
+
+    # Options of a GrabCut like this one, with changes: the current models (e.g. from the ModelCache,
+    # which is not shared) and instrumentation
+    def child_options(self, **changes):
+        options = dict(self.options, models=self.initModels, modelCache=None, instrumentation=self.instrumentation)
+        options.update(changes)
+        return options
+
+    # GrabCut of the region [y1:y2, x1:x2] with the same options and instrumentation, sharing beta
+    # and the N-link weights of this image when its graph has them
+    def crop(self, y1, y2, x1, x2):
+        graph = self.graph.crop(y1, y2, x1, x2, self.instrumentation) if isinstance(self.graph, GCGraph) else None
+        return GrabCut(self.img[y1:y2, x1:x2], **self.child_options(graph=graph))
+
+    '''
+    Segments several objects of the image at once, from rects (in this engine's format, see
+    rect_region) and/or trimaps of the whole image (one per object, BGD outside the object).
+    Each object is solved on its own crop: its rect or the bounding box of its non-BGD pixels,
+    padded by padding pixels of background, with its own GMMs. A background GMM learned from the
+    crop alone can miss most of the background's colors and lose the object, so the Python
+    engine's background GMMs also learn from the pixels outside every object (one pass over the
+    image per object), and OpenCV's crops are padded by at least half the object's larger side.
+    The crops share the decoded image, the instrumentation and, for the Python engine, beta and
+    the N-link weights of the whole image, and are solved in parallel by workers threads. Returns the label map, shape (h, w), 0 for the
+    background and i+1 for the i-th object (rects first), later objects winning where they
+    overlap; self.objects keeps the (region, GrabCut) of every object, see get_object_matte.
+    '''
+    def segment_objects(self, rects=(), masks=(), padding=32, workers=None):
+        self.instrumentation.start_run(engine='cv' if self.useCV else 'python', height=self.h, width=self.w,
+                                       objects=len(rects) + len(masks))
+        try:
+            # OpenCV only learns its background model from the crop, which needs more of it
+            def region(y1, y2, x1, x2):
+                pad = max(padding, max(y2 - y1, x2 - x1) // 2) if self.useCV else padding
+                return max(0, y1 - pad), min(self.h, y2 + pad), max(0, x1 - pad), min(self.w, x2 + pad)
+
+            tasks = []
+            for rect in rects:
+                ys, xs = self.rect_region(rect)
+                tasks.append((region(ys.start, ys.stop, xs.start, xs.stop), rect, None))
+            for mask in masks:
+                ys, xs = np.nonzero(np.asarray(mask).reshape(self.imgShape) != Trimap.BGD)
+                if len(ys) == 0:
+                    raise ValueError("An object mask has no foreground or unknown pixels")
+                tasks.append((region(ys.min(), ys.max() + 1, xs.min(), xs.max() + 1), None, mask))
+
+            # The background model of the Python engine's crops also learns from the whole image's
+            # pixels outside every object, like one GrabCut of the whole image would
+            outside = np.ones(self.imgShape, bool)
+            for rect in rects:
+                outside[self.rect_region(rect)] = False
+            for mask in masks:
+                outside[np.asarray(mask).reshape(self.imgShape) != Trimap.BGD] = False
+            bgdModel = None
+            if not self.useCV and outside.any():
+                with self.instrumentation.phase('outside_model'):
+                    bgdModel = GaussianMixtureModel(self.n_components, self.initMethod, self.initSamples, self.seed,
+                                                    self.instrumentation)
+                    components = np.zeros((self.N, ), np.uint8)
+                    components[outside.reshape(self.N)] = bgdModel.init_components(self.pixels[outside.reshape(self.N)])
+
+            def solve(task):
+                (y1, y2, x1, x2), rect, mask = task
+                grabcut = self.crop(y1, y2, x1, x2)
+                if bgdModel is not None:
+                    # The crop's own background pixels are counted by the crop
+                    select = outside.copy()
+                    select[y1:y2, x1:x2] = False
+                    grabcut.bgdPrior = bgdModel, bgdModel.statistics(self.pixels, components, select.reshape(self.N))
+                if rect is not None:
+                    rect = (rect[0] - x1, rect[1] - y1) + tuple(rect[2:]) if self.useCV else \
+                        (rect[0] - x1, rect[1] - y1, rect[2] - x1, rect[3] - y1)
+                    grabcut.segment(rect, None)
+                else:
+                    grabcut.segment(None, np.asarray(mask).reshape(self.imgShape)[y1:y2, x1:x2])
+                return (y1, y2, x1, x2), grabcut
+
+            with self.instrumentation.phase('objects'):
+                with ThreadPoolExecutor(workers) as pool:
+                    self.objects = list(pool.map(solve, tasks))
+            labels = np.zeros(self.imgShape, np.int32)
+            for i, ((y1, y2, x1, x2), grabcut) in enumerate(self.objects):
+                labels[y1:y2, x1:x2][grabcut.get_matte() == 1] = i + 1
+        finally:
+            self.instrumentation.finish_run()
+        return labels
+
+    # Matte of the i-th object of segment_objects, shape (h, w)
+    def get_object_matte(self, i):
+        (y1, y2, x1, x2), grabcut = self.objects[i]
+        matte = np.zeros(self.imgShape, np.uint8)
+        matte[y1:y2, x1:x2] = grabcut.get_matte()
+        return matte
+
+    # Returns the matte and the cutout, and also hands them to sink(matte, cutout) if given, e.g. file_sink.
+    # With borderMatting the cutout has the soft alpha.
+    def run(self, rect, init_mask, sink=None):
+        matte = self.segment(rect, init_mask)
+        cutout = self.get_cutout(matte if self.softAlpha is None else self.softAlpha)
+        if sink is not None:
+            sink(matte, cutout)
+        return matte, cutout
 
 
 if __name__ == '__main__':
     grabcut = GrabCut('../test_imgs/lena_small.jpg')
     rect = (10, 10, 168, 196)
-    grabcut.run(rect, None)
+    grabcut.run(rect, None, file_sink('../test_imgs/lena_small_result.png'))
 
@@ -3,9 +3,10 @@ import numpy as np
 import matplotlib.pyplot as plt
 from enum import IntEnum
 from PyQt5.QtWidgets import QFileDialog, QApplication, QMainWindow, QGraphicsScene
-from PyQt5.QtGui import QPixmap, QPen, QColor, QPainterPath, QBrush
-from PyQt5.QtCore import QRectF, QLineF, QPointF
-from GrabCut import GrabCut, Trimap
+from PyQt5.QtGui import QPixmap, QImage, QPen, QColor, QPainterPath, QBrush
+from PyQt5.QtCore import QRectF, QLineF, QPointF, QObject, QRunnable, QThreadPool, pyqtSignal
+from GrabCut import Trimap
+from GrabCutSession import GrabCutSession
 from GrabCutQtDesignerUI import Ui_MainWindow
 
 
@@ -21,6 +22,55 @@ class Color:
     BLUE = QColor(0, 0, 255)
 
 
+# Preview of a matte on its image: the background darkened and tinted red
+def matte_overlay(img, matte):
+    return np.where(matte[:, :, np.newaxis] == 1, img, img // 4 + np.array([0, 0, 96], np.uint8))
+
+
+class WorkerSignals(QObject):
+    preview = pyqtSignal(object)
+    finished = pyqtSignal(object)
+    error = pyqtSignal(str)
+
+
+class GrabCutWorker(QRunnable):
+    '''
+    Runs a GrabCutSession edit on the thread pool so that the window stays responsive.
+    The session is created first if needed (decoding, beta and N-links). preview emits the
+    matte overlay after every iteration and finished the session once it is done.
+    cancel() stops after the current iteration, the max-flow itself cannot be interrupted,
+    and the session keeps the matte of the last finished iteration.
+    '''
+    def __init__(self, session, imagePath, rect, seeds):
+        super(GrabCutWorker, self).__init__()
+        self.session = session
+        self.imagePath = imagePath
+        self.rect = rect
+        self.seeds = seeds
+        self.cancelled = False
+        self.signals = WorkerSignals()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def progress(self, matte):
+        self.signals.preview.emit(matte_overlay(self.session.grabcut.img, matte))
+        return not self.cancelled
+
+    def run(self):
+        try:
+            if self.session is None:
+                self.session = GrabCutSession(self.imagePath)
+            if self.rect is not None:
+                self.session.set_rect(self.rect, self.progress)
+            if self.seeds is not None and not self.cancelled:
+                self.session.add_seeds(self.seeds)
+        except Exception as e:
+            self.signals.error.emit(str(e))
+            return
+        self.signals.finished.emit(self.session)
+
+
 class ImageViewer(QGraphicsScene):
     def __init__(self):
         super(ImageViewer, self).__init__()
@@ -33,6 +83,7 @@ class ImageViewer(QGraphicsScene):
         self.toPos = None
         self.mask = None
         self.rect = None
+        self.pixmap = None
         self.pen = QPen()
 
     def setMode(self, mode):
@@ -40,9 +91,24 @@ class ImageViewer(QGraphicsScene):
 
     def setImage(self, imagePath):
         self.imagePath = imagePath
-        self.addPixmap(QPixmap(imagePath))
+        self.pixmap = self.addPixmap(QPixmap(imagePath))
         self.image = plt.imread(imagePath)
 
+    # Shows a BGR array, e.g. a GrabCut result, without going through a file.
+    # Replaces the shown image, drawn strokes stay on top of it.
+    def setArray(self, image):
+        self.image = np.ascontiguousarray(image[:, :, ::-1])
+        h, w = self.image.shape[:2]
+        pixmap = QPixmap.fromImage(QImage(self.image.data, w, h, 3 * w, QImage.Format_RGB888))
+        if self.pixmap is None:
+            self.pixmap = self.addPixmap(pixmap)
+        else:
+            self.pixmap.setPixmap(pixmap)
+
+    def clear(self):
+        super(ImageViewer, self).clear()
+        self.pixmap = None
+
     def setMask(self, fromPos, toPos, value):
         self.mask[int(fromPos.y()):int(toPos.y()), int(fromPos.x()):int(toPos.x())] = int(value)
 
@@ -103,7 +169,10 @@ class ImageViewer(QGraphicsScene):
 class GrabCutGUI(object):
     def __init__(self):
         self.imagePath = None
-        self.grabcut = None
+        self.session = None
+        # Running GrabCutWorker, None when idle
+        self.worker = None
+        self.threadPool = QThreadPool.globalInstance()
         self.app = QApplication(sys.argv)
         self.MainWindow = QMainWindow()
         self.ImageViewer = ImageViewer()
@@ -129,11 +198,16 @@ class GrabCutGUI(object):
 
     def openImage(self):
         self.imagePath, _ = QFileDialog.getOpenFileName(self.MainWindow, "Open Image", "" ,"Image files (*.jpg)")
+        self.stopWorker()
+        self.session = None
         self.ImageViewer.setImage(self.imagePath)
         self.ui.statusbar.showMessage("Opened " + self.imagePath)
 
     def saveImage(self):
         savePath, _ = QFileDialog.getSaveFileName(self.MainWindow, "Save Image As...", "")
+        if not savePath or self.session is None:
+            return
+        self.session.write_result(savePath)
         self.ui.statusbar.showMessage("Saved file to " + savePath)
 
     def setBackgroundRegion(self):
@@ -149,18 +223,69 @@ class GrabCutGUI(object):
         self.ImageViewer.setMode(EditMode.ADD_F_SEED)
 
     def clearInput(self):
+        self.stopWorker()
+        self.resetViewer()
+        self.session = None
+        if self.imagePath:
+            self.ImageViewer.setImage(self.imagePath)
+
+    def resetViewer(self):
         self.ImageViewer.rect = None
         self.ImageViewer.mask = None
         self.ImageViewer.clear()
-        self.grabcut = None
 
+    # Run doubles as Cancel while a worker is running
     def runGrabCut(self):
-        if self.grabcut is None:
-            self.grabcut = GrabCut(self.imagePath)
-        resultPath = self.grabcut.run(self.ImageViewer.rect, self.ImageViewer.mask)
-        self.imagePath = resultPath
-        self.clearInput()
-        self.ImageViewer.setImage(resultPath)
+        if self.worker is not None:
+            self.worker.cancel()
+            self.ui.runButton.setEnabled(False)
+            self.ui.statusbar.showMessage("Cancelling after the current iteration")
+            return
+        rect, mask = self.ImageViewer.rect, self.ImageViewer.mask
+        if self.session is None and rect is None:
+            self.ui.statusbar.showMessage("Set a background region first")
+            return
+        # Keep the session between runs, later strokes only re-solve their delta
+        worker = GrabCutWorker(self.session, self.imagePath, rect, mask)
+        worker.signals.preview.connect(lambda image: self.showPreview(worker, image))
+        worker.signals.finished.connect(lambda session: self.finishGrabCut(worker, session))
+        worker.signals.error.connect(lambda message: self.failGrabCut(worker, message))
+        self.worker = worker
+        # Strokes drawn while it runs are the input of the next run
+        self.resetViewer()
+        if self.session is None:
+            self.ImageViewer.setImage(self.imagePath)
+        else:
+            self.ImageViewer.setArray(self.session.result())
+        self.ui.runButton.setText("Cancel")
+        self.ui.statusbar.showMessage("Running GrabCut")
+        self.threadPool.start(worker)
+
+    # Forget the running worker, its signals are ignored from now on
+    def stopWorker(self):
+        if self.worker is not None:
+            self.worker.cancel()
+        self.worker = None
+        self.ui.runButton.setText("Run")
+        self.ui.runButton.setEnabled(True)
+
+    def showPreview(self, worker, image):
+        if worker is self.worker:
+            self.ImageViewer.setArray(image)
+
+    def finishGrabCut(self, worker, session):
+        if worker is not self.worker:
+            return
+        self.stopWorker()
+        self.session = session
+        self.ImageViewer.setArray(session.result())
+        self.ui.statusbar.showMessage("Cancelled" if worker.cancelled else "Done")
+
+    def failGrabCut(self, worker, message):
+        if worker is not self.worker:
+            return
+        self.stopWorker()
+        self.ui.statusbar.showMessage("GrabCut failed: " + message)
 
 if __name__ == '__main__':
     gui = GrabCutGUI()
\ No newline at end of file
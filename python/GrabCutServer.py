@@ -0,0 +1,299 @@
+import os
+import time
+import signal
+import email
+import email.policy
+import asyncio
+import argparse
+import multiprocessing
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import cv2 as cv
+from BatchGrabCut import BLAS_ENV_VARS, read_trimap
+
+MAX_BODY = 64 << 20
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def init_worker(blasThreads):
+    # Pay the imports and the first-call costs (cv2, maxflow, scipy) once per worker, not per request
+    cv.setNumThreads(blasThreads)
+    from GrabCut import GrabCut
+    img = np.random.default_rng(0).integers(0, 256, (32, 32, 3), np.uint8)
+    GrabCut(img, useCV=False).segment((4, 4, 28, 28), None)
+    GrabCut(img, useCV=True).segment((4, 4, 24, 24), None)
+
+
+'''
+Runs in a worker: segments the encoded image with a rect (x1, y1, x2, y2) and/or an encoded
+trimap mask (0 = background, 255 = foreground, anything else unknown), returns the PNG matte.
+Requests that waited past their deadline in the pool are dropped without being solved.
+'''
+def segment_request(image, mask, rect, options, deadline):
+    if time.time() > deadline:
+        raise TimeoutError("Expired in the queue")
+    from GrabCut import GrabCut
+    grabcut = GrabCut(image, **options)
+    if rect is not None and grabcut.useCV:
+        rect = (rect[0], rect[1], rect[2] - rect[0], rect[3] - rect[1])
+    trimap = None if mask is None else read_trimap(mask)
+    if trimap is not None and trimap.shape != grabcut.imgShape:
+        raise ValueError("The mask and the image have different sizes")
+    matte = grabcut.segment(rect, trimap)
+    return cv.imencode('.png', matte * 255)[1].tobytes()
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=None):
+        super(HTTPError, self).__init__(message or status.phrase)
+        self.status = status
+
+
+class Histogram(object):
+    '''Cumulative histogram in the Prometheus text format'''
+    def __init__(self, name, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[np.searchsorted(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self):
+        cumulative = np.cumsum(self.counts)
+        lines = ['# TYPE %s histogram' % self.name]
+        lines += ['%s_bucket{le="%g"} %d' % (self.name, le, n) for le, n in zip(self.buckets, cumulative)]
+        lines += ['%s_bucket{le="+Inf"} %d' % (self.name, cumulative[-1]),
+                  '%s_sum %f' % (self.name, self.sum), '%s_count %d' % (self.name, cumulative[-1])]
+        return lines
+
+
+class GrabCutServer(object):
+    '''
+    HTTP front end of a pool of warm GrabCut worker processes.
+    - POST /segment?rect=x1,y1,x2,y2 with the encoded image as body, or a multipart/form-data body
+    with an "image" and an optional "mask" part; optional query parameters iter, engine (cv or
+    python) and timeout (seconds). Answers with the PNG matte (0/255).
+    - At most workers requests are solved at a time, up to maxQueue more wait for a worker and
+    the rest are refused with 503 (backpressure). A request not answered within its timeout gets
+    504; if it was still waiting it is dropped, a running cut finishes but its result is discarded.
+    - GET /metrics: queue depth, requests in flight, requests by status and latency histograms.
+    - GET /health
+    '''
+    def __init__(self, workers=2, maxQueue=16, timeout=30., blasThreads=1, **options):
+        self.workers = workers
+        self.maxQueue = maxQueue
+        self.timeout = timeout
+        self.blasThreads = blasThreads
+        self.options = options
+        self.pool = None
+        self.slots = None
+        self.queued = 0
+        self.running = 0
+        self.responses = {}
+        self.latency = Histogram('grabcut_request_seconds')
+        self.queueWait = Histogram('grabcut_queue_wait_seconds')
+        self.solveTime = Histogram('grabcut_solve_seconds')
+
+    async def start_pool(self):
+        for var in BLAS_ENV_VARS:
+            os.environ[var] = str(self.blasThreads)
+        self.pool = ProcessPoolExecutor(self.workers, multiprocessing.get_context('spawn'),
+                                        init_worker, (self.blasThreads, ))
+        self.slots = asyncio.Semaphore(self.workers)
+        # Start every worker now rather than on the first requests
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.pool, time.sleep, 0.1) for _ in range(self.workers)])
+
+    async def dispatch(self, args):
+        loop = asyncio.get_running_loop()
+        slots = self.slots
+        start = time.perf_counter()
+        self.queued += 1
+        try:
+            await slots.acquire()
+        finally:
+            self.queued -= 1
+        self.queueWait.observe(time.perf_counter() - start)
+        self.running += 1
+
+        # The slot is only given back once the worker is done, even if the request timed out
+        def release(_):
+            self.running -= 1
+            slots.release()
+        try:
+            future = self.pool.submit(segment_request, *args)
+        except BaseException:
+            release(None)
+            raise
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(release, f))
+        start = time.perf_counter()
+        result = await asyncio.wrap_future(future)
+        self.solveTime.observe(time.perf_counter() - start)
+        return result
+
+    async def segment(self, query, headers, body):
+        if self.queued >= self.maxQueue:
+            raise HTTPError(HTTPStatus.SERVICE_UNAVAILABLE, "Queue full")
+        image, mask = body, None
+        contentType = headers.get('content-type', '')
+        if contentType.startswith('multipart/form-data'):
+            message = email.message_from_bytes(b'Content-Type: ' + contentType.encode() + b'\r\n\r\n' + body,
+                                               policy=email.policy.HTTP)
+            parts = {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+                     for part in message.iter_parts()}
+            image, mask = parts.get('image'), parts.get('mask')
+        if not image:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "No image")
+        try:
+            rect = tuple(int(v) for v in query['rect'][0].split(',')) if 'rect' in query else None
+            timeout = float(query.get('timeout', [self.timeout])[0])
+            options = dict(self.options)
+            if 'iter' in query:
+                options['iterCount'] = int(query['iter'][0])
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Bad query")
+        if rect is None and mask is None:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Give a rect or a mask")
+        if rect is not None and len(rect) != 4:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "rect is x1,y1,x2,y2")
+        if 'engine' in query:
+            options['useCV'] = query['engine'][0] == 'cv'
+        try:
+            return await asyncio.wait_for(self.dispatch((image, mask, rect, options, time.time() + timeout)),
+                                          timeout)
+        except (asyncio.TimeoutError, TimeoutError):
+            raise HTTPError(HTTPStatus.GATEWAY_TIMEOUT)
+        except (ValueError, IOError) as e:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, str(e))
+        except BrokenProcessPool:
+            # A worker died (e.g. out of memory), replace the whole pool
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            await self.start_pool()
+            raise HTTPError(HTTPStatus.INTERNAL_SERVER_ERROR, "Worker died")
+
+    def metrics(self):
+        lines = ['# TYPE grabcut_queue_depth gauge', 'grabcut_queue_depth %d' % self.queued,
+                 '# TYPE grabcut_in_flight gauge', 'grabcut_in_flight %d' % self.running,
+                 '# TYPE grabcut_workers gauge', 'grabcut_workers %d' % self.workers,
+                 '# TYPE grabcut_responses_total counter']
+        lines += ['grabcut_responses_total{status="%d"} %d' % item for item in sorted(self.responses.items())]
+        for histogram in (self.latency, self.queueWait, self.solveTime):
+            lines += histogram.lines()
+        return ('\n'.join(lines) + '\n').encode()
+
+    async def route(self, method, target, headers, body):
+        url = urlsplit(target)
+        if url.path == '/segment':
+            if method != 'POST':
+                raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED)
+            start = time.perf_counter()
+            try:
+                return 'image/png', await self.segment(parse_qs(url.query), headers, body)
+            finally:
+                self.latency.observe(time.perf_counter() - start)
+        if url.path == '/metrics' and method == 'GET':
+            return 'text/plain; version=0.0.4', self.metrics()
+        if url.path == '/health' and method == 'GET':
+            return 'text/plain', b'ok\n'
+        raise HTTPError(HTTPStatus.NOT_FOUND)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = None
+                try:
+                    request = await read_request(reader)
+                    if request is None:
+                        break
+                    method, target, headers, body = request
+                    contentType, payload = await self.route(method, target, headers, body)
+                    status = HTTPStatus.OK
+                except HTTPError as e:
+                    status, contentType, payload = e.status, 'text/plain', (str(e) + '\n').encode()
+                except Exception as e:
+                    status = HTTPStatus.INTERNAL_SERVER_ERROR
+                    contentType, payload = 'text/plain', (repr(e) + '\n').encode()
+                if request is not None and urlsplit(request[1]).path == '/segment':
+                    self.responses[status.value] = self.responses.get(status.value, 0) + 1
+                keepAlive = request is not None and request[2].get('connection', '').lower() != 'close'
+                head = ['HTTP/1.1 %d %s' % (status.value, status.phrase), 'Content-Type: ' + contentType,
+                        'Content-Length: %d' % len(payload), 'Connection: ' + ('keep-alive' if keepAlive else 'close')]
+                if status == HTTPStatus.SERVICE_UNAVAILABLE:
+                    head.append('Retry-After: 1')
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + payload)
+                await writer.drain()
+                if not keepAlive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    # Serves until SIGTERM or SIGINT, then closes the server and waits for the workers to exit,
+    # so that none outlives the process
+    async def serve(self, host='127.0.0.1', port=8080, ready=None):
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+        await self.start_pool()
+        try:
+            server = await asyncio.start_server(self.handle, host, port)
+            print("Serving on http://%s:%d with %d workers" % (host, port, self.workers), flush=True)
+            if ready is not None:
+                ready.set()
+            async with server:
+                await stop.wait()
+        finally:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+
+
+# Returns (method, target, headers, body), or None when the client closed the connection
+async def read_request(reader):
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    try:
+        method, target, _ = line.decode('latin-1').split()
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Bad request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY:
+        raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+    body = await reader.readexactly(length) if length else b''
+    return method, target, headers, body
+
+
+'''
+Local segmentation service, e.g.
+python GrabCutServer.py --port 8080 -j 4 --queue 32 --timeout 10
+curl --data-binary @cat.jpg 'http://127.0.0.1:8080/segment?rect=10,10,300,200' -o matte.png
+'''
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='GrabCut HTTP service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--queue', type=int, default=16, help='requests waiting for a worker before 503')
+    parser.add_argument('--timeout', type=float, default=30, help='default per-request timeout in seconds')
+    parser.add_argument('--blas-threads', type=int, default=1, help='BLAS/OpenCV threads per worker')
+    parser.add_argument('--iter', type=int, default=3)
+    parser.add_argument('--cv', action='store_true', help='use the OpenCV engine by default')
+    parser.add_argument('--pyramid', default='', help='comma separated scale factors, e.g. 0.5,0.25')
+    args = parser.parse_args()
+    server = GrabCutServer(args.workers, args.queue, args.timeout, args.blas_threads, iterCount=args.iter,
+                           useCV=args.cv, pyramid=tuple(float(s) for s in args.pyramid.split(',') if s))
+    asyncio.run(server.serve(args.host, args.port))
@@ -0,0 +1,65 @@
+import numpy as np
+from GrabCut import GrabCut, Trimap
+from Instrumentation import timeit
+from CutBackends import require_maxflow
+
+
+class GrabCutSession(object):
+    '''
+    Keeps one image's GrabCut state (decoded image, trimap, GMMs, N-links and the
+    max-flow of the last cut) alive between user edits.
+    - set_rect runs the full GrabCut iterations from a rect.
+    - add_seeds only clamps the T-links of the newly seeded pixels and re-solves
+    the max-flow starting from the previous flow.
+    - refine re-estimates the GMMs with the seeds in the trimap.
+    Needs PyMaxflow, the only backend that keeps its graph between cuts.
+    progress(matte), if given, is called with the (h, w) matte after every iteration, from the
+    thread running them, and returning False stops the remaining iterations. The first iteration
+    always runs so the graph exists for add_seeds.
+    '''
+    def __init__(self, imagePath, n_components=5, iterCount=1, instrumentation=None):
+        require_maxflow()
+        self.grabcut = GrabCut(imagePath, n_components, iterCount, useCV=False, reuseGraph=True,
+                               instrumentation=instrumentation, backend='pymaxflow')
+
+    @property
+    def instrumentation(self):
+        return self.grabcut.instrumentation
+
+    @timeit
+    def set_rect(self, rect, progress=None):
+        self.grabcut.init_with_rect(rect)
+        return self.refine(progress=progress)
+
+    def refine(self, iterCount=None, progress=None):
+        grabcut = self.grabcut
+        for _ in range(grabcut.iterCount if iterCount is None else iterCount):
+            if grabcut.iterate() < grabcut.minChanged:
+                break
+            if progress is not None and progress(grabcut.get_matte()) is False:
+                break
+        return grabcut.alpha
+
+    # seeds is a trimap of the image, only its BGD and FGD pixels are applied
+    @timeit
+    def add_seeds(self, seeds):
+        grabcut = self.grabcut
+        seeds = seeds.reshape(grabcut.N)
+        touched = np.flatnonzero((seeds != Trimap.UKN) & (seeds != grabcut.mask))
+        grabcut.mask[touched] = seeds[touched]
+        grabcut.graph.clamp_T_links(touched, seeds[touched])
+        grabcut.update_alpha(grabcut.graph.cut(reuse_trees=True))
+        return grabcut.alpha
+
+    def result(self):
+        grabcut = self.grabcut
+        return grabcut.img * grabcut.alpha.reshape(grabcut.imgShape)[:, :, np.newaxis]
+
+    def matte(self):
+        return self.grabcut.get_matte()
+
+    def cutout(self):
+        return self.grabcut.get_cutout()
+
+    def write_result(self, resultPath=None):
+        return self.grabcut.write_result(self.result(), resultPath)
@@ -0,0 +1,133 @@
+import io
+import json
+import time
+import threading
+import pstats
+import cProfile
+import tracemalloc
+import functools
+from contextlib import contextmanager
+
+
+class Instrumentation(object):
+    '''
+    Telemetry of GrabCut runs, shared by GrabCut, GCGraph and GaussianMixtureModel.
+    - phase times: total seconds and number of calls of each timed phase
+    - counters: last value of a quantity, e.g. beta or the number of graph edges
+    - series: one value per iteration, e.g. the max-flow value or the labels changed
+    A run (GrabCut.segment) produces one record that is passed to callback and/or appended
+    as a JSON line to jsonPath. profile adds the top cProfile entries of the run and
+    traceMemory the peak of the memory traced by tracemalloc (numpy allocations included).
+    '''
+    enabled = True
+
+    def __init__(self, callback=None, jsonPath=None, profile=False, traceMemory=False):
+        self.callback = callback
+        self.jsonPath = jsonPath
+        self.profile = profile
+        self.traceMemory = traceMemory
+        self.records = []
+        self.depth = 0
+        # Runs and phases may be recorded from several threads, e.g. GrabCut.segment_objects
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.phases = {}
+        self.counters = {}
+        self.series = {}
+        self.profiler = None
+        self.start = None
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                total, calls = self.phases.get(name, (0., 0))
+                self.phases[name] = (total + time.perf_counter() - start, calls + 1)
+
+    def count(self, name, value):
+        self.counters[name] = value
+
+    def append(self, name, value):
+        self.series.setdefault(name, []).append(value)
+
+    # Runs may be nested (e.g. the coarse levels of a pyramid), only the outermost makes a record.
+    # What is recorded between two runs (e.g. beta, computed by the constructor) goes to the next one.
+    def start_run(self, **info):
+        with self.lock:
+            self.depth += 1
+            if self.depth > 1:
+                return
+        self.counters.update(info)
+        if self.traceMemory:
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+        if self.profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.start = time.perf_counter()
+
+    def finish_run(self):
+        with self.lock:
+            self.depth -= 1
+            if self.depth > 0:
+                return None
+        record = {'time': time.perf_counter() - self.start,
+                  'phases': {name: {'time': t, 'calls': n} for name, (t, n) in self.phases.items()},
+                  'counters': self.counters, 'series': self.series}
+        if self.profiler is not None:
+            self.profiler.disable()
+            stream = io.StringIO()
+            pstats.Stats(self.profiler, stream=stream).sort_stats('cumulative').print_stats(20)
+            record['profile'] = stream.getvalue()
+        if self.traceMemory:
+            record['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+        self.records.append(record)
+        self.reset()
+        if self.callback is not None:
+            self.callback(record)
+        if self.jsonPath is not None:
+            with open(self.jsonPath, 'a') as f:
+                f.write(json.dumps(record, default=float) + '\n')
+        return record
+
+
+class NullInstrumentation(object):
+    '''Default, records nothing'''
+    enabled = False
+
+    @contextmanager
+    def phase(self, name):
+        yield
+
+    def count(self, name, value):
+        pass
+
+    def append(self, name, value):
+        pass
+
+    def start_run(self, **info):
+        pass
+
+    def finish_run(self):
+        return None
+
+
+NULL_INSTRUMENTATION = NullInstrumentation()
+
+
+# Times a method as a phase of its object's instrumentation, named after the method
+def timeit(func):
+    @functools.wraps(func)
+    def wrapper(self, *args, **kw):
+        instrumentation = self.instrumentation
+        if not instrumentation.enabled:
+            return func(self, *args, **kw)
+        with instrumentation.phase(func.__name__):
+            return func(self, *args, **kw)
+    return wrapper
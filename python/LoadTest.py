@@ -0,0 +1,118 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+import http.client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2 as cv
+from PyramidReport import IMG_DIR, test_images, default_rect
+
+
+def wait_ready(host, port, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection(host, port, timeout=5)
+            connection.request('GET', '/health')
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("The server did not start")
+
+
+# One client: keeps its connection alive and sends its share of the requests back to back
+def client(host, port, requests):
+    connection = http.client.HTTPConnection(host, port, timeout=600)
+    results = []
+    for path, body in requests:
+        start = time.perf_counter()
+        try:
+            connection.request('POST', path, body, {'Content-Type': 'image/jpeg'})
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            connection = http.client.HTTPConnection(host, port, timeout=600)
+            status = 0
+        results.append((status, time.perf_counter() - start))
+    return results
+
+
+def load_test(host, port, requests, concurrency):
+    shares = [requests[i::concurrency] for i in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = sum(pool.map(lambda share: client(host, port, share), shares), [])
+    elapsed = time.perf_counter() - start
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    ok = [latency for status, latency in results if status == 200]
+    print("%d requests, concurrency %d in %.1fs: %.2f ok/s, statuses %s" % (
+        len(results), concurrency, elapsed, len(ok) / elapsed, statuses))
+    if ok:
+        print("latency p50 %.3fs p95 %.3fs p99 %.3fs max %.3fs" % tuple(
+            np.percentile(ok, [50, 95, 99, 100])))
+    connection = http.client.HTTPConnection(host, port)
+    connection.request('GET', '/metrics')
+    print(connection.getresponse().read().decode())
+    return statuses, ok
+
+
+'''
+Load test of GrabCutServer with the images of test/imgs (resized to --size) and a fixed rect.
+Without --url a local server is started with the given workers and queue and stopped afterwards,
+e.g. python LoadTest.py -n 200 -c 16 -j 4 --queue 8 --timeout 5
+'''
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test of the GrabCut HTTP service')
+    parser.add_argument('--url', default=None, help='running server, e.g. http://127.0.0.1:8080')
+    parser.add_argument('--imgs', default=IMG_DIR)
+    parser.add_argument('--size', type=int, default=320, help='longest side of the test images')
+    parser.add_argument('-n', '--requests', type=int, default=100)
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument('--engine', default='python', choices=('python', 'cv'))
+    parser.add_argument('--iter', type=int, default=3)
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='workers of the local server')
+    parser.add_argument('--queue', type=int, default=16, help='queue size of the local server')
+    parser.add_argument('--timeout', type=float, default=30, help='per-request timeout of the local server')
+    parser.add_argument('--port', type=int, default=8765, help='port of the local server')
+    args = parser.parse_args()
+
+    images = []
+    for imagePath in test_images(args.imgs):
+        img = cv.imread(imagePath)
+        scale = args.size / max(img.shape[:2])
+        img = cv.resize(img, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+        rect = ','.join(map(str, default_rect(img.shape[:2], False)))
+        images.append(('/segment?rect=%s&engine=%s&iter=%d' % (rect, args.engine, args.iter),
+                       cv.imencode('.jpg', img)[1].tobytes()))
+    requests = [images[i % len(images)] for i in range(args.requests)]
+
+    server = None
+    if args.url is None:
+        host, port = '127.0.0.1', args.port
+        server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                'GrabCutServer.py'),
+                                   '--port', str(port), '-j', str(args.workers), '--queue', str(args.queue),
+                                   '--timeout', str(args.timeout)])
+    else:
+        url = urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+    try:
+        wait_ready(host, port)
+        load_test(host, port, requests, args.concurrency)
+    finally:
+        if server is not None:
+            # SIGTERM lets the server shut its worker pool down, killing it would orphan the workers
+            server.terminate()
+            try:
+                server.wait(60)
+            except subprocess.TimeoutExpired:
+                server.kill()
+                server.wait()
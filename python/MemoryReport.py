@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+import resource
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+import cv2 as cv
+from GrabCut import GrabCut
+from PyramidReport import iou
+
+
+def segment(imagePath, mattePath, options, queue):
+    start = time.time()
+    grabcut = GrabCut(imagePath, useCV=False, **options)
+    h, w = grabcut.imgShape
+    matte = grabcut.segment((w // 10, h // 10, w - w // 10, h - h // 10), None)
+    np.save(mattePath, matte)
+    # ru_maxrss is in KB on Linux
+    queue.put((time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+               float(matte.mean())))
+
+
+# Peak RSS (MB) of a fresh process segmenting the memory-mapped image, the matte is saved to mattePath
+def measure(imagePath, mattePath, **options):
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=segment, args=(imagePath, mattePath, options, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+'''
+Measure the peak RSS of the large image mode on a test image upscaled to a given size,
+e.g. python MemoryReport.py --megapixels 50 --tile 1024 --pyramid 0.25 --budget 4000
+exits with status 1 if the peak RSS goes over the budget. Tiles only see overlap pixels of
+context, so with --iou a tiled run is also compared with the same run untiled, which needs the
+memory of the untiled graph (its peak is reported apart, the budget is the tiled run's).
+'''
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Peak memory of GrabCut on a large image')
+    parser.add_argument('--image', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'HarryPotter5.jpg'))
+    parser.add_argument('--megapixels', type=float, default=8)
+    parser.add_argument('--tile', type=int, default=1024, help='tile size, 0 to solve the whole image at once')
+    parser.add_argument('--overlap', type=int, default=32, help='context pixels around every tile')
+    parser.add_argument('--iou', action='store_true', help='also run untiled and compare the tiled matte with it')
+    parser.add_argument('--pyramid', default='0.25', help='comma separated scale factors')
+    parser.add_argument('--iter', type=int, default=2)
+    parser.add_argument('--budget', type=float, default=None, help='memory budget in MB')
+    args = parser.parse_args()
+
+    img = cv.imread(args.image)
+    scale = np.sqrt(args.megapixels * 1e6 / (img.shape[0] * img.shape[1]))
+    img = cv.resize(img, None, fx=scale, fy=scale, interpolation=cv.INTER_CUBIC)
+    pyramid = tuple(float(s) for s in args.pyramid.split(',') if s)
+    with tempfile.TemporaryDirectory() as tmp:
+        imagePath, mattePath = os.path.join(tmp, 'image.npy'), os.path.join(tmp, 'matte.npy')
+        np.save(imagePath, img)
+        del img
+        elapsed, tiledPeak, coverage = measure(imagePath, mattePath, iterCount=args.iter, tileSize=args.tile or None,
+                                          tileOverlap=args.overlap, pyramid=pyramid)
+        print("%.1f MP, tile %s, pyramid %s: %.1fs, peak RSS %.0f MB, foreground %.1f%%" % (
+            args.megapixels, '%d (overlap %d)' % (args.tile, args.overlap) if args.tile else 'off',
+            args.pyramid or 'off', elapsed, tiledPeak, 100 * coverage))
+        if args.tile and args.iou:
+            untiledPath = os.path.join(tmp, 'untiled.npy')
+            elapsed, untiledPeak, _ = measure(imagePath, untiledPath, iterCount=args.iter, pyramid=pyramid)
+            tiled, untiled = np.load(mattePath), np.load(untiledPath)
+            print("untiled: %.1fs, peak RSS %.0f MB, IoU of the tiled matte %.3f, %.2f%% of the pixels differ" % (
+                elapsed, untiledPeak, iou(tiled, untiled), 100 * np.mean(tiled != untiled)))
+    if args.budget is not None and tiledPeak > args.budget:
+        print("Peak RSS over the budget of %.0f MB" % args.budget)
+        sys.exit(1)
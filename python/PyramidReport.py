@@ -0,0 +1,60 @@
+import os
+import time
+import argparse
+import numpy as np
+from GrabCut import GrabCut
+
+IMG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'imgs')
+
+
+def test_images(imgDir):
+    for filename in sorted(os.listdir(imgDir)):
+        name, ext = os.path.splitext(filename)
+        if ext.lower() == '.jpg' and not name.endswith('_result'):
+            yield os.path.join(imgDir, filename)
+
+
+# Fixed rect leaving a margin of 10% on every side, in the rect format of the engine
+def default_rect(shape, useCV):
+    h, w = shape
+    x1, y1, x2, y2 = w // 10, h // 10, w - w // 10, h - h // 10
+    return (x1, y1, x2 - x1, y2 - y1) if useCV else (x1, y1, x2, y2)
+
+
+def iou(a, b):
+    a, b = a.astype(bool), b.astype(bool)
+    union = np.count_nonzero(a | b)
+    return np.count_nonzero(a & b) / union if union else 1.
+
+
+def segment(imagePath, useCV, iterCount, pyramid, bandWidth):
+    start = time.time()
+    grabcut = GrabCut(imagePath, iterCount=iterCount, useCV=useCV, pyramid=pyramid, bandWidth=bandWidth)
+    matte = grabcut.segment(default_rect(grabcut.imgShape, useCV), None)
+    return matte, time.time() - start
+
+
+'''
+Compare coarse-to-fine segmentation against the full resolution result:
+IoU of the two mattes and speedup, for every image in test/imgs.
+'''
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Coarse-to-fine vs full resolution GrabCut report')
+    parser.add_argument('--imgs', default=IMG_DIR)
+    parser.add_argument('--pyramid', action='append', default=None,
+                        help='comma separated scale factors, e.g. 0.5,0.25 (repeatable)')
+    parser.add_argument('--band', type=int, default=None, help='band width in pixels, default 2 coarse pixels')
+    parser.add_argument('--iter', type=int, default=3)
+    parser.add_argument('--cv', action='store_true', help='use the OpenCV engine')
+    args = parser.parse_args()
+    pyramids = [tuple(float(s) for s in p.split(',')) for p in (args.pyramid or ['0.5', '0.5,0.25'])]
+
+    print('| image | size | full (s) | ' + ' | '.join('%s (s) | IoU' % ','.join(map(str, p)) for p in pyramids) + ' |')
+    print('|---' * (3 + 2 * len(pyramids)) + '|')
+    for imagePath in test_images(args.imgs):
+        ref, refTime = segment(imagePath, args.cv, args.iter, (), None)
+        row = [os.path.basename(imagePath), '%dx%d' % ref.shape[::-1], '%.2f' % refTime]
+        for pyramid in pyramids:
+            matte, t = segment(imagePath, args.cv, args.iter, pyramid, args.band)
+            row += ['%.2f (x%.1f)' % (t, refTime / t), '%.3f' % iou(ref, matte)]
+        print('| ' + ' | '.join(row) + ' |')
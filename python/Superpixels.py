@@ -0,0 +1,38 @@
+import numpy as np
+
+# OpenCV's contrib modules are optional, only the 'slic' method needs them
+try:
+	from cv2 import ximgproc
+except ImportError:
+	ximgproc = None
+
+
+# Regions of size x size pixels, labels of shape (h, w)
+def grid_regions(img, size):
+	h, w = img.shape[:2]
+	columns = (w + size - 1) // size
+	return (np.arange(h, dtype=np.int32)[:, np.newaxis] // size) * columns + np.arange(w, dtype=np.int32) // size
+
+
+# SLIC superpixels of about size x size pixels (SLICO, no compactness to tune)
+def slic_regions(img, size, iterations=10):
+	if ximgproc is None:
+		raise ImportError("SLIC superpixels need opencv-contrib-python, use the 'grid' method")
+	slic = ximgproc.createSuperpixelSLIC(np.ascontiguousarray(img), ximgproc.SLICO, size)
+	slic.iterate(iterations)
+	return slic.getLabels()
+
+
+SUPERPIXEL_METHODS = {'grid': grid_regions, 'slic': slic_regions}
+
+
+# Oversegmentation of img into regions that do not mix trimap labels: the superpixels of method
+# are split along the trimap. Returns the labels, shape (h, w) values 0..count-1, and count.
+def superpixels(img, trimap, size, method='grid'):
+	if method not in SUPERPIXEL_METHODS:
+		raise ValueError("Unknown superpixel method: " + method)
+	labels = SUPERPIXEL_METHODS[method](img, size).astype(np.int64) * 3 + trimap.reshape(img.shape[:2])
+	used = np.zeros((labels.max() + 1, ), bool)
+	used[labels] = True
+	index = (np.cumsum(used) - 1).astype(np.int32)
+	return index[labels], int(used.sum())
@@ -0,0 +1,198 @@
+import os
+import time
+import queue
+import argparse
+import threading
+import numpy as np
+import cv2 as cv
+from GrabCut import GrabCut, Trimap, read_image
+from GCGraph import BandGCGraph
+from Instrumentation import NULL_INSTRUMENTATION
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.bmp', '.npy')
+
+
+# BGR frames of a video file, a camera index or a directory of images (sorted by name)
+def read_frames(source):
+    if isinstance(source, str) and os.path.isdir(source):
+        for filename in sorted(os.listdir(source)):
+            if os.path.splitext(filename)[1].lower() in IMAGE_EXTS:
+                yield read_image(os.path.join(source, filename))
+        return
+    capture = cv.VideoCapture(source)
+    if not capture.isOpened():
+        raise IOError("Cannot open " + str(source))
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield frame
+    finally:
+        capture.release()
+
+
+# Runs the frames generator in a thread, up to depth frames ahead, so that decoding the next
+# frames overlaps with segmenting the current one (OpenCV's decoders release the GIL).
+# When the consumer stops early the thread stops too and closes frames (releasing its capture).
+def prefetch(frames, depth=4, timeout=0.1):
+    buffer = queue.Queue(depth)
+    stop = threading.Event()
+    done = object()
+    errors = []
+
+    # False once the consumer has stopped
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=timeout)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for frame in frames:
+                if not put(frame):
+                    break
+        except Exception as e:
+            errors.append(e)
+        finally:
+            if hasattr(frames, 'close'):
+                frames.close()
+            put(done)
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            frame = buffer.get()
+            if frame is done:
+                break
+            yield frame
+    finally:
+        stop.set()
+        producer.join()
+    if errors:
+        raise errors[0]
+
+
+class VideoGrabCut(object):
+    '''
+    Segments the frames of a sequence one after the other.
+    - The first frame runs GrabCut from rect (x1, y1, x2, y2) for initIters iterations.
+    - Every later frame gets a trimap from the previous matte: pixels deeper than bandWidth inside
+    it are FGD, deeper outside are BGD and the band between them is UKN, so the object may move
+    by up to bandWidth pixels per frame.
+    - The GMMs are carried over and refined by learnIters learn steps on learnSamples random
+    pixels labelled by the previous matte, instead of being clustered again, and beta is the
+    first frame's.
+    - The cut only has nodes for the band (BandGCGraph).
+    If the object is lost (empty matte) the next frame starts again from rect.
+    '''
+    def __init__(self, rect, bandWidth=8, iterCount=1, learnIters=1, learnSamples=20000, initIters=3,
+                 n_components=5, gamma=50, seed=0, instrumentation=None, neighborhood=8):
+        self.rect = rect
+        self.bandWidth = bandWidth
+        self.iterCount = iterCount
+        self.learnIters = learnIters
+        self.learnSamples = learnSamples
+        self.initIters = initIters
+        self.n_components = n_components
+        self.gamma = gamma
+        self.neighborhood = neighborhood
+        self.instrumentation = instrumentation or NULL_INSTRUMENTATION
+        self.rng = np.random.default_rng(seed)
+        self.seed = seed
+        self.kernel = cv.getStructuringElement(cv.MORPH_ELLIPSE, (2*bandWidth + 1, 2*bandWidth + 1))
+        self.models = None
+        self.beta = None
+        self.matte = None
+        self.frameCount = 0
+
+    def trimap(self, matte):
+        trimap = np.full(matte.shape, Trimap.UKN, np.uint8)
+        trimap[cv.erode(matte, self.kernel) == 1] = Trimap.FGD
+        trimap[cv.dilate(matte, self.kernel) == 0] = Trimap.BGD
+        return trimap
+
+    # Refine the GMMs on a random subset of the pixels, labelled by the previous matte
+    def learn(self, pixels, alpha):
+        sample = self.rng.integers(len(pixels), size=min(self.learnSamples, len(pixels)))
+        pixels, alpha = pixels[sample], alpha[sample]
+        for model, label in zip(self.models, (Trimap.BGD, Trimap.FGD)):
+            selected = pixels[alpha == label]
+            if len(selected) == 0:
+                continue
+            for _ in range(self.learnIters):
+                model.learn(selected, model.get_components(selected))
+
+    def first_frame(self, frame):
+        grabcut = GrabCut(frame, self.n_components, self.initIters, useCV=False, gamma=self.gamma,
+                          seed=self.seed, instrumentation=self.instrumentation, neighborhood=self.neighborhood)
+        matte = grabcut.segment(self.rect, None)
+        self.models = grabcut.get_models()
+        self.beta = grabcut.graph.beta
+        return matte
+
+    def segment(self, frame):
+        self.instrumentation.start_run(frame=self.frameCount)
+        try:
+            if self.matte is None or not self.matte.any():
+                matte = self.first_frame(frame)
+            else:
+                with self.instrumentation.phase('trimap'):
+                    trimap = self.trimap(self.matte)
+                graph = BandGCGraph(frame, self.gamma, self.beta, self.instrumentation, self.neighborhood)
+                pixels = frame.reshape(-1, 3)
+                alpha = self.matte.reshape(-1)
+                for _ in range(self.iterCount):
+                    with self.instrumentation.phase('learn'):
+                        self.learn(pixels, alpha)
+                    graph.build_graph(trimap, *self.models)
+                    alpha = graph.cut()
+                matte = alpha.reshape(frame.shape[:2])
+        finally:
+            self.instrumentation.finish_run()
+        self.matte = matte
+        self.frameCount += 1
+        return matte
+
+
+# Generator of (frame, matte) for the frames of source (see read_frames) or an iterable of frames
+def segment_video(source, rect, prefetchDepth=4, **options):
+    frames = read_frames(source) if isinstance(source, (str, int)) else source
+    video = VideoGrabCut(rect, **options)
+    for frame in prefetch(frames, prefetchDepth):
+        yield frame, video.segment(frame)
+
+
+'''
+Segments a video (or a directory of frames) from a rect on its first frame and reports the
+frame rate, e.g. python VideoGrabCut.py clip.mp4 --rect 100,50,500,400 --out matte.avi
+'''
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='GrabCut on a frame sequence')
+    parser.add_argument('source', help='video file, camera index or directory of images')
+    parser.add_argument('--rect', required=True, help='x1,y1,x2,y2 on the first frame')
+    parser.add_argument('--band', type=int, default=8, help='width of the unknown band in pixels')
+    parser.add_argument('--iter', type=int, default=1, help='learn + cut iterations per frame')
+    parser.add_argument('--learn-iters', type=int, default=1)
+    parser.add_argument('--out', default=None, help='video of the mattes (MJPG)')
+    args = parser.parse_args()
+
+    source = int(args.source) if args.source.isdigit() else args.source
+    writer = None
+    count = 0
+    start = time.perf_counter()
+    for frame, matte in segment_video(source, tuple(int(v) for v in args.rect.split(',')),
+                                      bandWidth=args.band, iterCount=args.iter, learnIters=args.learn_iters):
+        if args.out:
+            if writer is None:
+                writer = cv.VideoWriter(args.out, cv.VideoWriter_fourcc(*'MJPG'), 25, frame.shape[1::-1], False)
+            writer.write(matte * 255)
+        count += 1
+    elapsed = time.perf_counter() - start
+    if writer is not None:
+        writer.release()
+    print("%d frames in %.1fs: %.1f fps" % (count, elapsed, count / elapsed))
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules are run from python/, e.g. PYTHONPATH=. python GrabCut.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
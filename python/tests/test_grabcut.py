@@ -0,0 +1,160 @@
+import os
+import numpy as np
+import cv2 as cv
+import pytest
+from GMM import GaussianMixtureModel, dump_models, load_models_bytes, singular_fix
+from GCGraph import GCGraph, Trimap
+from GrabCut import GrabCut
+from CutBackends import maxflow
+from BorderMatting import border_matting
+
+IMAGE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'HarryPotter5.jpg')
+RECT = (15, 20, 75, 95)
+
+needs_maxflow = pytest.mark.skipif(maxflow is None, reason='needs PyMaxflow')
+
+
+@pytest.fixture(scope='module')
+def img():
+    return cv.resize(cv.imread(IMAGE), (90, 120), interpolation=cv.INTER_AREA)
+
+
+@pytest.fixture(scope='module')
+def grabcut(img):
+    grabcut = GrabCut(img, iterCount=2, useCV=False)
+    grabcut.segment(RECT, None)
+    return grabcut
+
+
+def rect_trimap(shape, rect):
+    trimap = np.full(shape, Trimap.BGD, np.uint8)
+    trimap[rect[1]:rect[3], rect[0]:rect[2]] = Trimap.UKN
+    return trimap
+
+
+def test_log_likelihoods_match_per_pixel(grabcut):
+    model = grabcut.fgdModel
+    pixels = grabcut.pixels[::7].astype(np.float64)
+    log_lik = model.component_log_likelihoods(pixels)
+    with np.errstate(divide='ignore'):
+        expected = np.log([[model.component_likelihood(p, k) for k in range(model.K)] for p in pixels])
+    # The per-pixel likelihoods lose precision then underflow to 0 far from a component
+    normal = expected > -700
+    np.testing.assert_allclose(log_lik[normal], expected[normal], rtol=0, atol=1e-9)
+    np.testing.assert_allclose(model.model_log_likelihood(pixels),
+                               np.log([model.model_likelihood(p) for p in pixels]), rtol=0, atol=1e-9)
+    assert np.array_equal(model.get_components(pixels), [model.get_component(p) for p in pixels])
+
+
+def test_log_likelihood_of_empty_model():
+    model = GaussianMixtureModel(2)
+    model.set_parameters([0., 0.], [[0., 0., 0.], [1., 1., 1.]], [np.eye(3), np.eye(3)])
+    assert np.all(model.model_log_likelihood(np.zeros((4, 3))) == -np.inf)
+
+
+def test_learn_matches_np_cov():
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, (500, 3)).astype(np.uint8)
+    # Component 2 is a single color, its covariance is singular
+    pixels[400:] = (10, 20, 30)
+    components = np.repeat(np.arange(3), (200, 200, 100)).astype(np.uint8)
+    model = GaussianMixtureModel(3)
+    model.learn(pixels, components)
+    np.testing.assert_allclose(model.weight, [0.4, 0.4, 0.2])
+    for k in range(3):
+        x = pixels[components == k].astype(np.float64)
+        cov = np.cov(x, rowvar=False)
+        cov += singular_fix(cov[np.newaxis])[0] * np.eye(3)
+        np.testing.assert_allclose(model.mean[k], x.mean(axis=0), atol=1e-9)
+        np.testing.assert_allclose(model.cov[k], cov, atol=1e-9)
+    assert np.linalg.det(model.cov[2]) >= 1e-6
+
+
+def test_learn_with_select(grabcut):
+    select = grabcut.alpha == 1
+    model, expected = GaussianMixtureModel(5), GaussianMixtureModel(5)
+    model.learn(grabcut.pixels, grabcut.components, select)
+    expected.learn(grabcut.pixels[select], grabcut.components[select])
+    np.testing.assert_allclose(model.weight, expected.weight)
+    # Components without pixels keep their (here uninitialized) parameters
+    learned = model.weight > 0
+    np.testing.assert_allclose(model.cov[learned], expected.cov[learned])
+
+
+def test_models_round_trip(grabcut):
+    models = grabcut.get_models()
+    data = dump_models(models)
+    assert len(data) == 2 * (6 + 80 * 5)
+    for model, loaded in zip(models, load_models_bytes(data)):
+        np.testing.assert_array_equal(model.weight, loaded.weight)
+        np.testing.assert_array_equal(model.mean, loaded.mean)
+        # Only the upper triangle is stored
+        np.testing.assert_array_equal(np.triu(model.cov), np.triu(loaded.cov))
+    model, offset = GaussianMixtureModel.from_bytes(models[0].to_bytes())
+    assert offset == 6 + 80 * 5
+    with pytest.raises(ValueError):
+        GaussianMixtureModel.from_bytes(b'XXXX' + data[4:])
+
+
+@pytest.mark.parametrize('backend', ['scipy', 'opencv'])
+@needs_maxflow
+def test_backends_agree(img, grabcut, backend):
+    trimap = rect_trimap(img.shape[:2], RECT)
+    labels = []
+    for name in ('pymaxflow', backend):
+        graph = GCGraph(img, backend=name)
+        graph.build_graph(trimap.reshape(-1), grabcut.bgdModel, grabcut.fgdModel)
+        labels.append(graph.cut())
+    assert np.array_equal(*labels)
+
+
+@needs_maxflow
+def test_reuse_graph_matches_plain_cut(img):
+    plain = GrabCut(img, iterCount=3, useCV=False).segment(RECT, None)
+    reused = GrabCut(img, iterCount=3, useCV=False, reuseGraph=True).segment(RECT, None)
+    assert np.array_equal(plain, reused)
+
+
+def test_tiles_with_whole_image_context_match_plain_cut(img):
+    plain = GrabCut(img, iterCount=2, useCV=False).segment(RECT, None)
+    # Every tile sees the whole image, so stitching is the only difference
+    tiled = GrabCut(img, iterCount=2, useCV=False, tileSize=32, tileOverlap=max(img.shape)).segment(RECT, None)
+    assert np.array_equal(plain, tiled)
+
+
+@needs_maxflow
+def test_session_seeds_match_fresh_cut(img):
+    from GrabCutSession import GrabCutSession
+    session = GrabCutSession(img, iterCount=2)
+    session.set_rect(RECT)
+    seeds = np.full(img.shape[:2], Trimap.UKN, np.uint8)
+    seeds[30:40, 30:50] = Trimap.BGD
+    seeds[60:70, 40:50] = Trimap.FGD
+    alpha = session.add_seeds(seeds)
+    grabcut = session.grabcut
+    graph = GCGraph(img)
+    graph.build_graph(grabcut.mask, grabcut.bgdModel, grabcut.fgdModel)
+    assert np.array_equal(alpha, graph.cut())
+    assert np.all(alpha.reshape(img.shape[:2])[seeds == Trimap.BGD] == 0)
+    assert np.all(alpha.reshape(img.shape[:2])[seeds == Trimap.FGD] == 1)
+
+
+def test_border_matting(img, grabcut):
+    matte = grabcut.get_matte()
+    alpha = border_matting(img, matte, bandWidth=2)
+    assert alpha.dtype == np.float32 and alpha.min() >= 0 and alpha.max() <= 1
+    # Away from the boundary the hard matte is kept
+    kernel = np.ones((7, 7), np.uint8)
+    inside = cv.erode(matte, kernel) == 1
+    assert np.all(alpha[inside] == 1)
+    with pytest.raises(ValueError):
+        border_matting(img, matte, bandWidth=0)
+
+
+def test_crop_keeps_options_and_color_table(img):
+    parent = GrabCut(img, iterCount=2, useCV=False, quantize=6, gamma=30)
+    child = parent.crop(10, 70, 5, 60)
+    assert child.img.shape == (60, 55, 3)
+    assert child.graph.table is child.table and len(child.table.index) == 60 * 55
+    assert child.options == dict(parent.options, instrumentation=parent.instrumentation)
+    assert child.graph.beta == parent.graph.beta